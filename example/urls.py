@@ -14,6 +14,7 @@ urlpatterns = patterns('',
     url(r'^$', RedirectView.as_view(url='/projects/')),
     url(r'^paypal/', include('zipfelchappe.paypal.urls')),
     url(r'^postfinance/', include('zipfelchappe.postfinance.urls')),
+    url(r'^events/', include('zipfelchappe.event_urls')),
     # url(r'^tinymce/', include('tinymce.urls')),
     url(r'', include('feincms.urls')),
 )
@@ -1,15 +1,14 @@
 from __future__ import unicode_literals, absolute_import
-import csv
-import ast
 from datetime import datetime
 
 from django import forms
 from django.conf.urls import patterns, url
+from django.core.urlresolvers import reverse
 from django.db import models
 from django.db.models.loading import get_model
 from django.contrib import admin
 from django.contrib.admin import util
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
@@ -17,7 +16,9 @@ from django.utils.translation import ugettext_lazy as _
 from feincms.admin import item_editor
 
 from .models import Project, Pledge, Backer, Update, Reward, MailTemplate
-from .models import ExtraField
+from .models import ExtraField, QueuedMail, PaymentNotification, ExportJob
+from .export import csv_lines
+from .utils import format_html
 from .widgets import AdminImageWidget, TestMailWidget
 
 from .paypal.models import Preapproval, Payment
@@ -25,54 +26,27 @@ from .app_settings import BACKER_PROFILE
 
 
 def export_as_csv(modeladmin, request, queryset):
-    model = modeladmin.model
-    response = HttpResponse(mimetype='text/csv')
-    model_name = force_unicode(model._meta.verbose_name)
+    model_name = force_unicode(modeladmin.model._meta.verbose_name)
     timestamp = datetime.now().strftime('%d%m%y_%H%M')
     filename = '%s_export_%s.csv' % (model_name, timestamp)
+    response = StreamingHttpResponse(csv_lines(modeladmin, queryset),
+        content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename=%s' % filename
-    writer = csv.writer(response)
-    excluded = getattr(modeladmin, 'export_excluded', [])
-    field_names = set(modeladmin.list_display) - set(excluded)
-
-    def get_label(field):
-        label = util.label_for_field(field, model, modeladmin)
-        return force_unicode(label).title().encode('utf-8')
-
-    def serialize(field, obj):
-        f, attr, value = util.lookup_field(field, obj, modeladmin)
-        if f is not None and not isinstance(f, models.BooleanField):
-            value = util.display_for_field(value, f)
-        return force_unicode(value).encode('utf-8')
-
-    header_row = [get_label(field) for field in field_names]
-
-    if queryset.count() > 0:
-        first = queryset[0]
-        if hasattr(first, 'export_related'):
-            header_row += first.export_related().keys()
-
-    writer.writerow(header_row)
+    return response
 
-    for obj in queryset:
-        field_values = [serialize(field, obj) for field in field_names]
+export_as_csv.short_description = _('Export as csv')
 
-        if callable(getattr(obj, 'export_related', False)):
-            field_values += obj.export_related().values()
 
-        if hasattr(obj, 'extradata'):
-            try:
-                data = ast.literal_eval(obj.extradata)
-            except SyntaxError:
-                data = {}
-            values = [v.encode('utf-8') for v in data.values()]
-            field_values += values
+def export_as_csv_in_background(modeladmin, request, queryset):
+    job = ExportJob(user=request.user)
+    job.set_queryset(queryset)
+    job.save()
+    modeladmin.message_user(request, _('The export has been queued. You can '
+        'download it from the exports list once it is done.'))
 
-        writer.writerow(field_values)
 
-    return response
-
-export_as_csv.short_description = _('Export as csv')
+export_as_csv_in_background.short_description = _(
+    'Export as csv in the background')
 
 
 class PledgeInlineAdmin(admin.TabularInline):
@@ -89,7 +63,8 @@ class BackerAdmin(admin.ModelAdmin):
     search_fields = ('_first_name', '_last_name', '_email', 'user__username', 'user__email')
     raw_id_fields = ['user']
     inlines = [PledgeInlineAdmin]
-    actions = [export_as_csv]
+    actions = [export_as_csv, export_as_csv_in_background]
+    export_select_related = ('user',)
 
 
 if BACKER_PROFILE:
@@ -186,6 +161,10 @@ class PledgeAdmin(admin.ModelAdmin):
             return _('(None)')
     email.short_description = _('email')
 
+    def get_queryset(self, request):
+        return super(PledgeAdmin, self).get_queryset(request).prefetch_related(
+            'extra_values')
+
     def amount_display(self, pledge):
         return '%s %s' % (pledge.amount, pledge.currency)
     amount_display.short_description = _('amount')
@@ -215,18 +194,12 @@ class PledgeAdmin(admin.ModelAdmin):
         obj = self.get_object(request, util.unquote(object_id))
         ExtraForm = obj.project.extraform()
 
-        try:
-            extra_data = ast.literal_eval(obj.extradata)
-        except SyntaxError:
-            extra_data = {}
-
         if request.method == 'POST':
             extra_form = ExtraForm(request.POST)
             if extra_form.is_valid():
-                obj.extradata = extra_form.clean()
-                obj.save()
+                obj.set_extra_data(extra_form.cleaned_data)
         else:
-            extra_form = ExtraForm(initial=extra_data)
+            extra_form = ExtraForm(initial=obj.extra_data)
 
         extra_context['extraform'] = extra_form
 
@@ -234,14 +207,11 @@ class PledgeAdmin(admin.ModelAdmin):
             form_url, extra_context=extra_context)
 
     def extradata_display(self, pledge):
-        try:
-            data = ast.literal_eval(pledge.extradata)
-            display = ''
-            for key, value in data.items():
-                display += '<div><strong>%s:</strong> %s</div>' % (key, value)
-            return display
-        except:
-            return pledge.extradata
+        display = ''
+        for key, value in sorted(pledge.extra_data.items()):
+            display += format_html('<div><strong>{0}:</strong> {1}</div>',
+                key, value)
+        return display
     extradata_display.allow_tags = True
     extradata_display.short_description = 'Extra Data'
 
@@ -258,6 +228,7 @@ class PledgeAdmin(admin.ModelAdmin):
     )
 
     export_excluded = ('extradata_display',)
+    export_select_related = ('backer__user', 'reward')
 
     list_display_links = (
         'username',
@@ -272,6 +243,7 @@ class PledgeAdmin(admin.ModelAdmin):
         'backer__user__first_name',
         'backer__user__last_name',
         'backer__user__email',
+        'extra_values__value',
     )
 
     raw_id_fields = ('backer', 'project')
@@ -282,7 +254,7 @@ class PledgeAdmin(admin.ModelAdmin):
         PaypalFilter,
         RewardListFilter
     )
-    actions = [export_as_csv]
+    actions = [export_as_csv, export_as_csv_in_background]
     exclude = ('extradata',)
 
 
@@ -307,12 +279,12 @@ class RewardInlineAdmin(admin.StackedInline):
             'fields': [
                 ('minimum', 'quantity'),
                 'description',
-                'reserved',
+                ('reserved', 'claimed'),
             ]
         }]
     ]
 
-    readonly_fields = ('reserved',)
+    readonly_fields = ('reserved', 'claimed')
 
 
 class MailTemplateForm(forms.ModelForm):
@@ -414,3 +386,59 @@ class ProjectAdmin(item_editor.ItemEditor):
 
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(Pledge, PledgeAdmin)
+
+
+class QueuedMailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipient', 'status', 'attempts',
+        'next_attempt')
+    list_filter = ('status',)
+    search_fields = ('recipient', 'subject')
+    readonly_fields = ('attempts', 'last_error')
+    date_hierarchy = 'created'
+
+
+admin.site.register(QueuedMail, QueuedMailAdmin)
+
+
+class PaymentNotificationAdmin(admin.ModelAdmin):
+    list_display = ('created', 'provider', 'key', 'status', 'attempts')
+    list_filter = ('provider', 'status')
+    search_fields = ('key',)
+    readonly_fields = ('attempts', 'last_error')
+    date_hierarchy = 'created'
+
+
+admin.site.register(PaymentNotification, PaymentNotificationAdmin)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'created', 'user', 'status', 'rows',
+        'download_link')
+    list_filter = ('status', 'model')
+    readonly_fields = ('user', 'model', 'status', 'rows', 'error')
+    exclude = ('object_ids', 'file')
+
+    def has_add_permission(self, request):
+        return False
+
+    def download_link(self, job):
+        if job.status != ExportJob.DONE:
+            return ''
+        url = reverse('admin:zipfelchappe_exportjob_download', args=(job.pk,))
+        return format_html('<a href="{0}">{1}</a>', url, _('Download'))
+    download_link.allow_tags = True
+    download_link.short_description = _('file')
+
+    def get_urls(self):
+        from . import admin_views
+        urls = patterns(
+            '',
+            url(r'^(?P<job_id>\d+)/download/$',
+                self.admin_site.admin_view(admin_views.download_export),
+                name='zipfelchappe_exportjob_download'
+                ),
+        )
+        return urls + super(ExportJobAdmin, self).get_urls()
+
+
+admin.site.register(ExportJob, ExportJobAdmin)
@@ -1,14 +1,17 @@
 from __future__ import unicode_literals, absolute_import
+import os
 
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
-
+from django.core.servers.basehttp import FileWrapper
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.views.decorators.csrf import csrf_exempt
 
 from smtplib import SMTPException
 from django.views.decorators.http import require_POST
 
-from .models import Project, Backer, Pledge, MailTemplate
+from .models import Project, Backer, Pledge, MailTemplate, ExportJob
 from .emails import send_pledge_completed_message
 
 try:
@@ -112,3 +115,18 @@ def collect_pledge(request, project_id, pledge_id):
             return JsonResponse(pf_data)
         except PostfinanceException as e:
             return JsonResponse({'error': e.message}, status=400)
+
+
+@staff_member_required
+def download_export(request, job_id):
+    """ Exports contain personal data, so they are not served as media """
+    job = get_object_or_404(ExportJob, pk=job_id, status=ExportJob.DONE)
+    path = os.path.join(settings.MEDIA_ROOT, job.file.name)
+    if not os.path.isfile(path):
+        raise Http404
+    response = StreamingHttpResponse(FileWrapper(open(path, 'rb')),
+        content_type='application/gzip')
+    response['Content-Length'] = os.path.getsize(path)
+    response['Content-Disposition'] = 'attachment; filename=%s' % (
+        os.path.basename(path))
+    return response
@@ -12,8 +12,25 @@ PAGINATE_BACKERS_BY = getattr(settings, 'ZIPFELCHAPPE_PAGINATE_BACKERS', 25)
 
 ALLOW_ANONYMOUS_PLEDGES = getattr(settings, 'ZIPFELCHAPPE_ALLOW_ANONYMOUS_PLEDGES', True)
 
+# Minutes a limited reward is held for a pledge that is not authorized yet
+REWARD_HOLD_MINUTES = getattr(settings, 'ZIPFELCHAPPE_REWARD_HOLD_MINUTES', 60)
+
+# Seconds the project lists are cached. Changes invalidate them right away,
+# the timeout only bounds projects going online or ending.
+CACHE_TIMEOUT = getattr(settings, 'ZIPFELCHAPPE_CACHE_TIMEOUT', 300)
+
+# Live funding updates, see zipfelchappe.events. Disabled if None.
+EVENT_BROKER = getattr(settings, 'ZIPFELCHAPPE_EVENT_BROKER',
+    'zipfelchappe.events.CacheBroker')
+EVENT_INTERVAL = getattr(settings, 'ZIPFELCHAPPE_EVENT_INTERVAL', 2)  # seconds
+EVENT_STREAM_TIMEOUT = getattr(settings,
+    'ZIPFELCHAPPE_EVENT_STREAM_TIMEOUT', 300)  # seconds
+
 BACKER_PROFILE = getattr(settings, 'ZIPFELCHAPPE_BACKER_PROFILE', None)
 
+# Objects loaded at once by the csv export
+EXPORT_CHUNK_SIZE = getattr(settings, 'ZIPFELCHAPPE_EXPORT_CHUNK_SIZE', 1000)
+
 PAYMENT_PROVIDERS = getattr(settings, 'ZIPFELCHAPPE_PAYMENT_PROVIDERS',
     (
         ('paypal', _('Paypal')),
@@ -22,4 +39,19 @@ PAYMENT_PROVIDERS = getattr(settings, 'ZIPFELCHAPPE_PAYMENT_PROVIDERS',
 
 ROOT_URLS = getattr(settings, 'ZIPFELCHAPPE_URLS', 'zipfelchappe.urls')
 
-
+# Outgoing mail queue, see the send_queued_mails management command
+MAIL_BATCH_SIZE = getattr(settings, 'ZIPFELCHAPPE_MAIL_BATCH_SIZE', 100)
+MAIL_MAX_ATTEMPTS = getattr(settings, 'ZIPFELCHAPPE_MAIL_MAX_ATTEMPTS', 5)
+MAIL_RETRY_DELAY = getattr(settings,
+    'ZIPFELCHAPPE_MAIL_RETRY_DELAY', 60)  # seconds
+MAIL_CLAIM_TIMEOUT = getattr(settings,
+    'ZIPFELCHAPPE_MAIL_CLAIM_TIMEOUT', 3600)  # seconds
+
+# Payment notifications, see the process_notifications management command
+IPN_PROCESSORS = getattr(settings, 'ZIPFELCHAPPE_IPN_PROCESSORS', {
+    'paypal': 'zipfelchappe.paypal.tasks.process_ipn',
+    'postfinance': 'zipfelchappe.postfinance.tasks.process_ipn',
+})
+IPN_MAX_ATTEMPTS = getattr(settings, 'ZIPFELCHAPPE_IPN_MAX_ATTEMPTS', 10)
+IPN_RETRY_DELAY = getattr(settings,
+    'ZIPFELCHAPPE_IPN_RETRY_DELAY', 60)  # seconds
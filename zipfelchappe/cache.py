@@ -0,0 +1,70 @@
+"""
+Versioned keys for the cached template fragments of zipfelchappe.
+
+Fragments are never deleted from the cache. Instead every fragment key
+contains the current version of its namespace, and changes to the underlying
+objects bump that version so the old fragments are not used anymore. The
+versions are bumped once the changes have been committed, so that no
+concurrent request caches the old data under the new version.
+"""
+from __future__ import absolute_import
+import time
+from functools import partial
+
+from django.core.cache import cache
+from django.utils.translation import get_language
+
+from .utils import on_commit
+
+VERSION_KEY = 'zipfelchappe:version:%s'
+
+
+def get_version(namespace):
+    """ Returns the current version of a namespace """
+    key = VERSION_KEY % namespace
+    version = cache.get(key)
+    if version is None:
+        # Start from the current time, so a version that has been evicted
+        # from the cache is never reused
+        cache.add(key, int(time.time() * 1000))
+        version = cache.get(key, 0)
+    return version
+
+
+def bump_version(namespace):
+    """ Invalidates all fragments of a namespace """
+    key = VERSION_KEY % namespace
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000))
+
+
+def fragment_key(namespace, *parts):
+    """ Returns the vary_on value of a fragment for the {% cache %} tag. It
+        contains the namespace version, the active language and parts. """
+    parts = (get_version(namespace), get_language()) + parts
+    return ':'.join(unicode(part) for part in parts)
+
+
+def project_namespace(project_id):
+    """ Namespace of the fragments that show a single project """
+    return 'project:%s' % project_id
+
+
+def invalidate_project_lists(sender, **kwargs):
+    on_commit(partial(bump_version, 'projects'))
+
+
+def invalidate_project(sender, instance, **kwargs):
+    on_commit(partial(bump_version, project_namespace(instance.pk)))
+
+
+def invalidate_project_of(sender, instance, **kwargs):
+    """ Invalidates the project of a reward or another related object """
+    on_commit(partial(bump_version, project_namespace(instance.project_id)))
+
+
+def invalidate_project_funding(sender, project_id, **kwargs):
+    # funding_changed is only sent after the commit
+    bump_version(project_namespace(project_id))
@@ -2,6 +2,7 @@ from django.db import models
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 
+from .app_settings import CACHE_TIMEOUT
 from .models import Project
 
 
@@ -21,6 +22,7 @@ class ProjectTeaserContent(models.Model):
             'content': self,
             'ct': True,
             'project': self.project,
+            'cache_timeout': CACHE_TIMEOUT,
         })
 
 
@@ -44,5 +46,6 @@ class ProjectTeaserRowContent(models.Model):
     def render(self, request, *args, **kwargs):
         return render_to_string('zipfelchappe/project_teaser_row.html', {
             'content': self,
-            'project_list': (self.project1, self.project2, self.project3)
+            'project_list': (self.project1, self.project2, self.project3),
+            'cache_timeout': CACHE_TIMEOUT,
         })
@@ -1,9 +1,22 @@
+import logging
+from datetime import timedelta
+from smtplib import SMTPRecipientsRefused
+
 from django.conf import settings
-from django.core.mail import send_mail
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection, send_mail
+from django.db.models import F, Q, signals
 from django.template import Context, Template
 from django.template.loader import render_to_string
+from django.utils.timezone import now
+from django.utils.translation import get_language
+
+from .app_settings import MAIL_BATCH_SIZE, MAIL_MAX_ATTEMPTS, MAIL_RETRY_DELAY
+from .app_settings import MAIL_CLAIM_TIMEOUT
+from .models import Backer, MailTemplate, Pledge, QueuedMail, Update
+from .utils import LRUCache
 
-from .models import MailTemplate
+logger = logging.getLogger('zipfelchappe.emails')
 
 
 def render_mail(template, context):
@@ -16,25 +29,252 @@ def render_mail(template, context):
     return subject, message
 
 
-def send_pledge_completed_message(pledge, mail_template=None):
-    """ Send message after backer successfully pledged to a project """
+# Compiled (subject, message) templates of mail templates
+compiled_templates = LRUCache(maxsize=100)
+
+
+def compile_mail_template(mail_template):
+    """
+    Returns the compiled subject and message templates of a mail template in
+    the current language. Saved templates are cached by primary key, language
+    and modification time, unsaved ones (e.g. test mails) by their source.
+    """
+    if isinstance(mail_template, MailTemplate) and mail_template.pk:
+        key = (mail_template.pk, get_language(), mail_template.modified)
+    else:
+        key = (None, mail_template.subject, mail_template.template)
+
+    templates = compiled_templates.get(key)
+    if templates is None:
+        source = mail_template.translated if key[0] else mail_template
+        templates = (Template(source.subject), Template(source.template))
+        compiled_templates.set(key, templates)
+
+    return templates
+
+
+def forget_mail_template(mail_template_id):
+    """ Removes all compiled templates of a mail template from the cache """
+    compiled_templates.discard(lambda key: key[0] == mail_template_id)
+
+
+def render_pledge_completed_message(pledge, mail_template=None):
+    """ Returns subject and message to send after a successful pledge """
 
     # Try to get template from project if not explictly passed
     if mail_template is None:
         try:
             mail_template = MailTemplate.objects.get(
-                project=pledge.project,
+                project=pledge.project_id,
                 action=MailTemplate.ACTION_THANKYOU
-            ).translated
+            )
         except MailTemplate.DoesNotExist:
             pass
 
     if mail_template is not None:
         context = Context({'pledge': pledge})
-        subject = Template(mail_template.subject).render(context)
-        message = Template(mail_template.template).render(context)
+        subject_template, message_template = compile_mail_template(
+            mail_template)
+        subject = subject_template.render(context)
+        message = message_template.render(context)
     else:
         subject, message = render_mail('pledge_completed', {'pledge': pledge})
 
+    return subject, message
+
+
+def send_pledge_completed_message(pledge, mail_template=None):
+    """ Send message after backer successfully pledged to a project """
+    subject, message = render_pledge_completed_message(pledge, mail_template)
     send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
         [pledge.backer.email], fail_silently=True)
+
+
+def queue_pledge_completed_message(pledge, mail_template=None):
+    """ Like send_pledge_completed_message but sent by the mail queue """
+    subject, message = render_pledge_completed_message(pledge, mail_template)
+    return queue_mail(subject, message, pledge.backer.email)
+
+
+def queue_mail(subject, message, recipient, from_email=None):
+    """ Adds a mail to the outgoing queue """
+    return QueuedMail.objects.create(
+        subject=subject,
+        message=message,
+        recipient=recipient,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+    )
+
+
+def send_queued_mails(batch_size=MAIL_BATCH_SIZE):
+    """
+    Sends one batch of due mails over a single connection. Failed mails are
+    retried after MAIL_RETRY_DELAY seconds, doubling the delay with each
+    attempt, and marked as failed after MAIL_MAX_ATTEMPTS attempts.
+
+    The mails are claimed before they are sent, so runs can overlap. Claimed
+    mails of a run that died are sent again after MAIL_CLAIM_TIMEOUT seconds.
+
+    Returns the number of mails sent and failed.
+    """
+    current = now()
+    due = QueuedMail.objects.filter(
+        status__in=(QueuedMail.QUEUED, QueuedMail.SENDING),
+        next_attempt__lte=current,
+    ).order_by('pk')[:batch_size]
+
+    claimed_until = current + timedelta(seconds=MAIL_CLAIM_TIMEOUT)
+    mails = []
+    for mail in due:
+        # Fails if a concurrent run claimed the mail in the meantime
+        if QueuedMail.objects.filter(pk=mail.pk, status=mail.status,
+                next_attempt=mail.next_attempt).update(
+                status=QueuedMail.SENDING, next_attempt=claimed_until):
+            mails.append(mail)
+
+    if not mails:
+        return 0, 0
+
+    sent, failed = [], []
+    connection = get_connection()
+    try:
+        connection.open()
+        for mail in mails:
+            message = EmailMessage(mail.subject, mail.message,
+                mail.from_email, [mail.recipient], connection=connection)
+            try:
+                connection.send_messages([message])
+            except Exception as e:
+                failed.append((mail, e))
+            else:
+                sent.append(mail.pk)
+    except Exception as e:
+        # Could not connect at all, the whole batch failed
+        sent_ids = set(sent)
+        failed = [(mail, e) for mail in mails if mail.pk not in sent_ids]
+    finally:
+        connection.close()
+
+    QueuedMail.objects.filter(pk__in=sent).update(status=QueuedMail.SENT,
+        attempts=F('attempts') + 1, modified=now())
+
+    for mail, error in failed:
+        mail.attempts += 1
+        mail.last_error = repr(error)
+        if mail.attempts >= MAIL_MAX_ATTEMPTS:
+            mail.status = QueuedMail.FAILED
+            logger.error('Giving up on mail %s: %s' % (mail.pk, error))
+        else:
+            mail.status = QueuedMail.QUEUED
+            delay = MAIL_RETRY_DELAY * 2 ** (mail.attempts - 1)
+            mail.next_attempt = now() + timedelta(seconds=delay)
+        mail.save()
+
+    return len(sent), len(failed)
+
+
+def update_mail_recipients(update, after=0, chunk_size=MAIL_BATCH_SIZE):
+    """
+    Yields the emails of the backers with an authorized pledge for the
+    project of the update as (emails, last backer pk) chunks, ordered by pk
+    and starting after the backer pk given. Each email is only yielded for
+    the first backer that has it, also across chunks.
+    """
+    backers = Backer.objects.filter(
+        pledges__project=update.project_id,
+        pledges__status__gte=Pledge.AUTHORIZED,
+    ).distinct()
+
+    while True:
+        chunk = list(backers.filter(pk__gt=after).order_by('pk').values_list(
+            'pk', 'user__email', '_email')[:chunk_size].iterator())
+        if not chunk:
+            return
+
+        # Backer.email, the address of the user comes first
+        emails = [user_email or email for pk, user_email, email in chunk]
+        addresses = set(email for email in emails if email)
+        seen = set(
+            user_email or email for user_email, email in backers.filter(
+                Q(user__email__in=addresses) | Q(_email__in=addresses),
+                pk__lt=chunk[0][0]).values_list('user__email', '_email'))
+
+        recipients = []
+        for email in emails:
+            if email and email not in seen:
+                seen.add(email)
+                recipients.append(email)
+        yield recipients, chunk[-1][0]
+        after = chunk[-1][0]
+
+
+def render_update_mail(update, site):
+    """ Returns the subject and message of the mail about an update """
+    context = {
+        'project': update.project,
+        'update': update,
+        'site': site,
+    }
+    subject = render_to_string(
+        'zipfelchappe/emails/new_update_subject.txt', context).strip()
+    message = render_to_string(
+        'zipfelchappe/emails/new_update_message.txt', context)
+    return subject, message
+
+
+def send_update_mails(update, chunk_size=MAIL_BATCH_SIZE):
+    """
+    Notifies all backers of a project about a published update. Backers
+    have no language of their own, so the mail is rendered once in the
+    current language. It is sent in chunks over one connection and the
+    progress is saved after each chunk, so an interrupted run continues where
+    it stopped.
+
+    Returns the number of mails sent.
+    """
+    subject, body = render_update_mail(update, Site.objects.get_current())
+
+    mails_sent = 0
+    connection = get_connection()
+    connection.open()
+    try:
+        for recipients, last_pk in update_mail_recipients(update,
+                update.mails_checkpoint or 0, chunk_size):
+            for email in recipients:
+                message = EmailMessage(subject, body,
+                    settings.DEFAULT_FROM_EMAIL, [email],
+                    connection=connection)
+                try:
+                    connection.send_messages([message])
+                    mails_sent += 1
+                except SMTPRecipientsRefused:
+                    logger.warning('Update mail refused for %s' % email)
+
+            update.mails_checkpoint = last_pk
+            Update.objects.filter(pk=update.pk).update(
+                mails_checkpoint=update.mails_checkpoint)
+    finally:
+        connection.close()
+
+    update.mails_sent = True
+    Update.objects.filter(pk=update.pk).update(mails_sent=True)
+    return mails_sent
+
+
+def mail_template_changed(sender, instance, **kwargs):
+    forget_mail_template(instance.pk)
+
+
+def mail_template_translation_changed(sender, instance, **kwargs):
+    forget_mail_template(instance.translation_of_id)
+
+
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(mail_template_changed, sender=MailTemplate)
+
+if 'zipfelchappe.translations' in settings.INSTALLED_APPS:
+    from .translations.models import MailTemplateTranslation
+
+    for signal in (signals.post_save, signals.post_delete):
+        signal.connect(mail_template_translation_changed,
+            sender=MailTemplateTranslation)
@@ -0,0 +1,7 @@
+from django.conf.urls import patterns, url
+
+# Streams can't be rendered into a feincms page, include these urls directly
+urlpatterns = patterns('zipfelchappe.views',
+    url(r'^(?P<slug>[\w-]+)/$', 'project_events',
+        name='zipfelchappe_project_events'),
+)
@@ -0,0 +1,126 @@
+"""
+Live funding updates as server-sent events.
+
+A broker tells the event streams when the funding of a project changes. The
+CacheBroker polls the cache version of the project, which costs one cache
+lookup per poll and sees the changes of all processes sharing the cache. The
+DatabaseBroker polls the modification time of the project instead. The
+LocalBroker is notified by the funding_changed signal and only sees changes
+made in the same process, e.g. in development or tests.
+"""
+import threading
+import time
+
+from django.utils.module_loading import import_by_path
+
+from .app_settings import EVENT_BROKER, EVENT_INTERVAL, EVENT_STREAM_TIMEOUT
+from .cache import get_version, project_namespace
+from .models import Project
+from .signals import funding_changed
+
+# Seconds between comments that keep idle connections open
+KEEPALIVE = 15
+
+
+class LocalBroker(object):
+    """ Counts the funding changes of each project in this process """
+
+    def __init__(self):
+        self._versions = {}
+        self._condition = threading.Condition()
+
+    def publish(self, project_id):
+        with self._condition:
+            self._versions[project_id] = self._versions.get(project_id, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, project_id, token, timeout):
+        """ Waits until the project changed since token was returned, at most
+            timeout seconds. Returns the current token. """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._versions.get(project_id, 0) == token:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._versions.get(project_id, 0)
+
+
+class CacheBroker(object):
+    """ Polls the version of the cached fragments of the project, which is
+        bumped once changes to its funding have been committed. Needs a cache
+        that is shared by all processes, e.g. memcached. """
+
+    def __init__(self, poll_interval=EVENT_INTERVAL):
+        self.poll_interval = poll_interval
+
+    def publish(self, project_id):
+        pass  # Bumped by zipfelchappe.cache
+
+    def current(self, project_id):
+        return get_version(project_namespace(project_id))
+
+    def wait(self, project_id, token, timeout):
+        deadline = time.time() + timeout
+        while True:
+            current = self.current(project_id)
+            if current != token or time.time() + self.poll_interval > deadline:
+                return current
+            time.sleep(self.poll_interval)
+
+
+class DatabaseBroker(CacheBroker):
+    """ Polls the modification time of the project, which changes with its
+        funding counters """
+
+    def publish(self, project_id):
+        pass  # Already stored with the funding counters
+
+    def current(self, project_id):
+        return Project.objects.filter(pk=project_id).values_list(
+            'modified', flat=True).first()
+
+
+_broker = None
+
+
+def get_broker():
+    """ Returns the configured broker or None if events are disabled """
+    global _broker
+    if _broker is None and EVENT_BROKER:
+        _broker = import_by_path(EVENT_BROKER)()
+    return _broker
+
+
+def event_stream(broker, project_id, get_data, interval=EVENT_INTERVAL,
+                 timeout=EVENT_STREAM_TIMEOUT):
+    """ Yields a server-sent event with get_data() whenever the project
+        changes, but at most one per interval. The stream ends after timeout
+        seconds and browsers reconnect on their own. """
+    deadline = time.time() + timeout
+    token = None
+    yield 'retry: %d\n\n' % (interval * 1000)
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        current = broker.wait(project_id, token, min(remaining, KEEPALIVE))
+        if current == token:
+            yield ': keepalive\n\n'
+            continue
+
+        token = current
+        yield 'event: funding\ndata: %s\n\n' % get_data()
+        # Changes until the next interval are sent as one event
+        time.sleep(interval)
+
+
+def publish_funding_change(sender, project_id, **kwargs):
+    broker = get_broker()
+    if broker is not None:
+        broker.publish(project_id)
+
+
+funding_changed.connect(publish_funding_change)
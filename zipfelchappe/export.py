@@ -0,0 +1,218 @@
+"""
+CSV export of admin querysets. Rows are produced in chunks, so exports of
+any size need about the same amount of memory.
+"""
+from __future__ import unicode_literals, absolute_import
+import csv
+import gzip
+import os
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin import util
+from django.db import models
+from django.db.models.fields import AutoField
+from django.db.models.fields.related import RelatedField
+from django.utils.encoding import force_unicode
+
+from .app_settings import BACKER_PROFILE, EXPORT_CHUNK_SIZE
+from .models import ExportJob
+
+
+def get_profile_model():
+    """ Returns the backer profile model or None if there is none """
+    if not BACKER_PROFILE:
+        return None
+    app_label, model_name = BACKER_PROFILE.split('.')
+    return models.get_model(app_label, model_name)
+
+
+def encode(value):
+    return force_unicode(value).encode('utf-8')
+
+
+def iterate_in_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE, after=None):
+    """ Yields lists of at most chunk_size objects ordered by primary key,
+        starting after the primary key given """
+    queryset = queryset.order_by('pk')
+    while True:
+        chunk = queryset
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1].pk
+
+
+def iterate_ids_in_chunks(queryset, object_ids, chunk_size=EXPORT_CHUNK_SIZE,
+                          after=None):
+    """ Like iterate_in_chunks, but only for the objects of the sorted
+        primary keys given. Each chunk is loaded by its own primary keys. """
+    if after is not None:
+        object_ids = [pk for pk in object_ids if pk > after]
+    for start in range(0, len(object_ids), chunk_size):
+        chunk = list(queryset.filter(
+            pk__in=object_ids[start:start + chunk_size]).order_by('pk'))
+        if chunk:
+            yield chunk
+
+
+class CSVExporter(object):
+    """
+    Turns objects of an admin into CSV rows with the columns of list_display
+    that are not in export_excluded. Related objects in export_select_related
+    are joined. For pledges the backer profile and the extra data follow.
+    """
+
+    def __init__(self, modeladmin, queryset):
+        self.modeladmin = modeladmin
+        self.model = modeladmin.model
+        excluded = getattr(modeladmin, 'export_excluded', [])
+        self.field_names = [field for field in modeladmin.list_display
+            if field not in excluded]
+
+        related = getattr(modeladmin, 'export_select_related', ())
+        self.queryset = queryset.select_related(*related) if related \
+            else queryset
+
+        # Only pledges know about backer profiles and extra data
+        self.with_related = hasattr(self.model, 'export_related')
+        if self.with_related:
+            self.queryset = self.queryset.prefetch_related('extra_values')
+        self.profile_model = self.with_related and get_profile_model()
+        self.profile_fields = []
+        if self.profile_model:
+            self.profile_fields = [f for f in self.profile_model._meta.fields
+                if not isinstance(f, (AutoField, RelatedField))]
+
+    def header(self):
+        row = [encode(force_unicode(util.label_for_field(field, self.model,
+            self.modeladmin)).title()) for field in self.field_names]
+        row += [encode(f.verbose_name) for f in self.profile_fields]
+        return row
+
+    def load_profiles(self, objects):
+        """ Fetches the backer profiles of a chunk with one query """
+        if not self.profile_model:
+            return {}
+        backer_ids = [obj.backer_id for obj in objects if obj.backer_id]
+        profiles = self.profile_model._default_manager.filter(
+            backer__in=backer_ids)
+        return dict((profile.backer_id, profile) for profile in profiles)
+
+    def serialize(self, field, obj):
+        f, attr, value = util.lookup_field(field, obj, self.modeladmin)
+        if f is not None and not isinstance(f, models.BooleanField):
+            value = util.display_for_field(value, f)
+        return encode(value)
+
+    def row(self, obj, profiles):
+        row = [self.serialize(field, obj) for field in self.field_names]
+
+        if self.profile_fields:
+            profile = profiles.get(obj.backer_id)
+            row += [encode(getattr(profile, f.name)) if profile else ''
+                for f in self.profile_fields]
+
+        if self.with_related:
+            data = obj.extra_data
+            row += [encode(data[key]) for key in sorted(data)]
+
+        return row
+
+    def chunks(self, chunk_size=EXPORT_CHUNK_SIZE, after=None,
+               object_ids=None):
+        """ Yields lists of (object pk, row) for all objects after the pk
+            given, only for the sorted primary keys object_ids if given """
+        if object_ids is None:
+            chunks = iterate_in_chunks(self.queryset, chunk_size, after)
+        else:
+            chunks = iterate_ids_in_chunks(self.queryset, object_ids,
+                chunk_size, after)
+        for chunk in chunks:
+            profiles = self.load_profiles(chunk)
+            yield [(obj.pk, self.row(obj, profiles)) for obj in chunk]
+
+    def rows(self, chunk_size=EXPORT_CHUNK_SIZE, after=None):
+        """ Yields (object pk, row) for all objects after the pk given """
+        for chunk in self.chunks(chunk_size, after):
+            for pk, row in chunk:
+                yield pk, row
+
+
+class Echo(object):
+    """ File like object that returns what is written to it """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(modeladmin, queryset):
+    """ Yields the lines of a CSV export, header first """
+    exporter = CSVExporter(modeladmin, queryset)
+    writer = csv.writer(Echo())
+    yield writer.writerow(exporter.header())
+    for pk, row in exporter.rows():
+        yield writer.writerow(row)
+
+
+def gzip_rows(rows):
+    """ Returns csv rows as a complete gzip member """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as compressed:
+        writer = csv.writer(compressed)
+        writer.writerows(rows)
+    return buf.getvalue()
+
+
+def run_export_job(job, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the gzip compressed csv file of an export job. Every chunk is
+    appended as a gzip member of its own and the job is saved after each
+    chunk, so an interrupted job continues after the last complete chunk.
+    """
+    model = job.get_model()
+    modeladmin = admin.site._registry[model]
+    exporter = CSVExporter(modeladmin, model._default_manager.all())
+
+    if not job.file:
+        job.file.name = 'exports/%s_export_%s.csv.gz' % (
+            model._meta.model_name, job.pk)
+    path = os.path.join(settings.MEDIA_ROOT, job.file.name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    job.status = ExportJob.RUNNING
+    job.save()
+
+    def checkpoint(output, pk, count):
+        output.flush()
+        os.fsync(output.fileno())
+        job.size = output.tell()
+        job.checkpoint = pk
+        job.rows += count
+        job.save(update_fields=('file', 'size', 'checkpoint', 'rows',
+            'status', 'modified'))
+
+    if job.size:
+        # Drop whatever was written after the last checkpoint
+        output = open(path, 'r+b')
+        output.truncate(job.size)
+        output.seek(job.size)
+    else:
+        output = open(path, 'wb')
+        output.write(gzip_rows([exporter.header()]))
+        job.rows = 0
+        checkpoint(output, None, 0)
+
+    with output:
+        for chunk in exporter.chunks(chunk_size, after=job.checkpoint,
+                object_ids=job.get_object_ids()):
+            output.write(gzip_rows(row for pk, row in chunk))
+            checkpoint(output, chunk[-1][0], len(chunk))
+
+    job.status = ExportJob.DONE
+    job.save()
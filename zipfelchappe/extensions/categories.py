@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.db import models
+from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 
 from feincms import extensions
 
+from ..cache import invalidate_project_lists
 from ..models import Category
 
 
@@ -22,6 +24,8 @@ class Extension(extensions.Extension):
             verbose_name=_('categories'), related_name='projects',
             null=True, blank=True)
         )
+        signals.m2m_changed.connect(invalidate_project_lists,
+            sender=self.model.categories.through)
 
     def handle_modeladmin(self, modeladmin):
         admin.site.register(Category, CategoryAdmin)
@@ -4,12 +4,15 @@ from django.core.exceptions import ValidationError
 from django.core.validators import EMPTY_VALUES
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
+from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
 from django.template.loader import render_to_string
 
+from .cache import fragment_key, project_namespace
 from .models import Pledge
 from .widgets import BootstrapRadioSelect
 from .app_settings import ALLOW_ANONYMOUS_PLEDGES, PAYMENT_PROVIDERS
+from .app_settings import CACHE_TIMEOUT
 
 
 class RewardChoiceIterator(forms.models.ModelChoiceIterator):
@@ -92,14 +95,31 @@ class BackProjectForm(forms.ModelForm):
 
         super(BackProjectForm, self).__init__(*args, **kwargs)
 
-        self.fields['reward'].queryset = self.project.rewards.all()
+        self.fields['reward'].queryset = \
+            self.project.rewards.with_translations()
         self.fields['reward'].label_from_instance = self.label_for_reward
+        self.fields['reward'].cache_choices = True
+        self.fields['reward'].choice_cache = self.get_reward_choices()
 
         if len(PAYMENT_PROVIDERS) <= 1:
             del self.fields['provider']
         else:
             self.fields['provider'].choices = PAYMENT_PROVIDERS
 
+    def get_reward_choices(self):
+        """ Returns the rendered reward choices. They are cached until the
+            project, its rewards or the claimed rewards change. """
+        key = 'zipfelchappe:reward_choices:%s' % fragment_key(
+            project_namespace(self.project.pk))
+        choices = cache.get(key)
+        if choices is None:
+            field = self.fields['reward']
+            choices = [
+                (field.prepare_value(reward), self.label_for_reward(reward))
+                for reward in field.queryset]
+            cache.set(key, choices, CACHE_TIMEOUT)
+        return choices
+
     def label_for_reward(self, reward):
         return render_to_string('zipfelchappe/reward_option.html', {
             'reward': reward,
@@ -127,7 +147,11 @@ class BackProjectForm(forms.ModelForm):
         if reward and amount and reward.minimum > amount:
             raise forms.ValidationError(_('Amount is to low for a reward!'))
 
-        if reward and not reward.is_available:
+        # The unit held by the pledge being edited is still available to it
+        instance = self.instance
+        holds_reward = bool(instance.pk and instance.reward_claimed and
+                            instance.reward_id == getattr(reward, 'pk', None))
+        if reward and not reward.is_available and not holds_reward:
             raise forms.ValidationError(
                 _('Sorry, this reward is not available anymore.')
             )
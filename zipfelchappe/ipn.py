@@ -0,0 +1,139 @@
+"""
+Payment notifications (IPN) are stored by the provider views and applied
+later by the process_notifications management command, using the processor
+configured for the provider in ZIPFELCHAPPE_IPN_PROCESSORS.
+"""
+from __future__ import unicode_literals, absolute_import
+import logging
+from datetime import timedelta
+from hashlib import sha1
+from urllib import urlencode
+
+from django.db.models import Q
+from django.utils.module_loading import import_by_path
+from django.utils.timezone import now
+
+from .app_settings import IPN_PROCESSORS, IPN_MAX_ATTEMPTS, IPN_RETRY_DELAY
+from .models import PaymentNotification, ProcessedNotification
+from .models import NotificationRejected
+from .utils import atomic
+
+logger = logging.getLogger('zipfelchappe.ipn')
+
+
+def payload_hash(data):
+    """ Hash of POST data that does not depend on the order of the fields """
+    fields = sorted((k, v.encode('utf-8')) for k, values in data.lists()
+        for v in values)
+    return sha1(urlencode(fields)).hexdigest()
+
+
+def queue_notification(provider, key, status, data):
+    """ Stores the POST data of a notification for later processing """
+    return PaymentNotification.objects.create(
+        provider=provider,
+        key=key or '',
+        reported_status=status or '',
+        payload=data.urlencode(),
+        payload_hash=payload_hash(data),
+    )
+
+
+def get_processor(provider):
+    return import_by_path(IPN_PROCESSORS[provider])
+
+
+def apply_notification(notification):
+    """
+    Applies a notification unless the same message has been applied before.
+    Returns False for duplicates.
+
+    A processor can have a verify function that checks the message with the
+    provider first, e.g. by a http request. It is called outside of the
+    transaction, so a slow provider does not hold any locks.
+    """
+    ledger = {
+        'provider': notification.provider,
+        'key': notification.key,
+        'status': notification.reported_status,
+        'payload_hash': notification.payload_hash,
+    }
+    if ProcessedNotification.objects.filter(**ledger).exists():
+        return False
+
+    processor = get_processor(notification.provider)
+    verify = getattr(processor, 'verify', None)
+    if verify is not None:
+        verify(notification.data)
+
+    with atomic():
+        processor(notification.data)
+        # Fails if a concurrent worker applied the same message
+        ProcessedNotification.objects.create(**ledger)
+    return True
+
+
+def process_notifications(batch_size=100):
+    """
+    Applies one batch of due notifications in the order they were received.
+    Notifications that cannot be applied are retried later, doubling the
+    delay each time, and later notifications with the same key wait for them.
+    Notifications rejected by the processor are not retried, messages that
+    have been applied before are skipped.
+
+    Returns the number of notifications processed, skipped as duplicates,
+    rejected and failed.
+    """
+    current = now()
+    waiting = PaymentNotification.objects.filter(
+        status=PaymentNotification.NEW,
+        next_attempt__gt=current,
+    )
+    # Keys with a notification waiting for a retry are left out in the
+    # query, so that they do not fill up the batch
+    blocked_keys = Q()
+    for provider in IPN_PROCESSORS:
+        blocked_keys |= Q(provider=provider, key__in=waiting.filter(
+            provider=provider).values('key'))
+
+    notifications = PaymentNotification.objects.filter(
+        status=PaymentNotification.NEW,
+        next_attempt__lte=current,
+    ).exclude(blocked_keys).order_by('pk')[:batch_size]
+
+    # Keys that failed in this batch
+    blocked = set()
+
+    results = {'processed': 0, 'duplicate': 0, 'rejected': 0, 'failed': 0}
+    for notification in notifications:
+        if (notification.provider, notification.key) in blocked:
+            continue
+
+        try:
+            applied = apply_notification(notification)
+        except NotificationRejected as e:
+            notification.status = PaymentNotification.REJECTED
+            notification.last_error = unicode(e)
+            logger.warning('Rejected %s: %s' % (notification, e))
+            results['rejected'] += 1
+        except Exception as e:
+            notification.attempts += 1
+            notification.last_error = repr(e)
+            if notification.attempts >= IPN_MAX_ATTEMPTS:
+                notification.status = PaymentNotification.FAILED
+                logger.error('Giving up on %s: %r' % (notification, e))
+            else:
+                delay = IPN_RETRY_DELAY * 2 ** (notification.attempts - 1)
+                notification.next_attempt = now() + timedelta(seconds=delay)
+                blocked.add((notification.provider, notification.key))
+            results['failed'] += 1
+        else:
+            if applied:
+                notification.status = PaymentNotification.PROCESSED
+                results['processed'] += 1
+            else:
+                notification.status = PaymentNotification.DUPLICATE
+                results['duplicate'] += 1
+        notification.save()
+
+    return results
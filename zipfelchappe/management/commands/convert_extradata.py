@@ -0,0 +1,24 @@
+import ast
+
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.export import iterate_in_chunks
+from zipfelchappe.models import Pledge
+
+
+class Command(BaseCommand):
+    help = 'Move the extra data of pledges into PledgeExtraValue rows'
+
+    def handle(self, *args, **options):
+        pledges_converted = 0
+        pledges = Pledge.objects.exclude(extradata='')
+        for chunk in iterate_in_chunks(pledges):
+            for pledge in chunk:
+                try:
+                    data = ast.literal_eval(pledge.extradata)
+                except (SyntaxError, ValueError):
+                    print "Could not read extra data of pledge %d" % pledge.pk
+                    continue
+                pledge.set_extra_data(data)
+                pledges_converted += 1
+        print "Total pledges converted: %d" % pledges_converted
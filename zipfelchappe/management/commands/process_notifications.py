@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.ipn import process_notifications
+
+
+class Command(BaseCommand):
+    help = 'Apply the payment notifications received from payment providers'
+
+    def handle(self, *args, **options):
+        total = {'processed': 0, 'duplicate': 0, 'rejected': 0, 'failed': 0}
+        while True:
+            results = process_notifications()
+            if not any(results.values()):
+                break
+            for name, count in results.items():
+                total[name] += count
+        print "Total notifications processed: %d" % total['processed']
+        print "Total duplicate notifications: %d" % total['duplicate']
+        print "Total notifications rejected: %d" % total['rejected']
+        print "Total notifications failed: %d" % total['failed']
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.models import Reward
+
+
+class Command(BaseCommand):
+    help = 'Give back rewards held by pledges that were never authorized'
+
+    def handle(self, *args, **options):
+        holds_released = 0
+        for pledge in Reward.objects.expired_holds().iterator():
+            if pledge.release_reward():
+                holds_released += 1
+        print "Total reward holds released: %d" % holds_released
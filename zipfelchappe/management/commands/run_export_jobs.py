@@ -0,0 +1,30 @@
+import traceback
+
+from django.contrib import admin
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.export import run_export_job
+from zipfelchappe.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = 'Write the csv files of queued exports'
+
+    def handle(self, *args, **options):
+        # The exports use the columns of the registered model admins
+        admin.autodiscover()
+
+        # Running jobs have been interrupted and continue where they stopped
+        jobs = ExportJob.objects.filter(
+            status__in=(ExportJob.QUEUED, ExportJob.RUNNING)).order_by('pk')
+
+        jobs_done = 0
+        for job in jobs:
+            try:
+                run_export_job(job)
+                jobs_done += 1
+            except Exception:
+                job.status = ExportJob.FAILED
+                job.error = traceback.format_exc()
+                job.save()
+        print "Total exports done: %d" % jobs_done
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.emails import send_queued_mails
+
+
+class Command(BaseCommand):
+    help = 'Send queued mails and retry mails that could not be sent'
+
+    def handle(self, *args, **options):
+        mails_sent = mails_failed = 0
+        while True:
+            sent, failed = send_queued_mails()
+            if not sent and not failed:
+                break
+            mails_sent += sent
+            mails_failed += failed
+        print "Total mails sent: %d" % mails_sent
+        print "Total mails failed: %d" % mails_failed
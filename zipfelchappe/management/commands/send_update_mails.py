@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.emails import send_update_mails
+from zipfelchappe.models import Update
+
+
+class Command(BaseCommand):
+    help = 'Notify backers about newly published updates'
+
+    def handle(self, *args, **options):
+        updates = Update.objects.filter(
+            status=Update.STATUS_PUBLISHED,
+            mails_sent=False,
+            mails_checkpoint__isnull=False,
+        ).select_related('project')
+
+        mails_sent = 0
+        for update in updates:
+            mails_sent += send_update_mails(update)
+        print "Total update mails sent: %d" % mails_sent
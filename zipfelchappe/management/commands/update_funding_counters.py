@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from zipfelchappe.models import Project, Pledge, Reward
+
+
+class Command(BaseCommand):
+    help = ('Recalculate the stored funding counters of all projects and the'
+            ' claimed counters of all rewards')
+
+    def handle(self, *args, **options):
+        projects_updated = 0
+        for project in Project.objects.all():
+            project.update_funding_counters()
+            projects_updated += 1
+        print "Total projects updated: %d" % projects_updated
+
+        # Authorized pledges always hold their reward, failed ones never do
+        Pledge.objects.filter(status__gte=Pledge.AUTHORIZED,
+            reward__isnull=False).update(reward_claimed=True)
+        Pledge.objects.filter(status=Pledge.FAILED).update(
+            reward_claimed=False)
+
+        rewards_updated = 0
+        for reward in Reward.objects.all():
+            reward.update_claimed()
+            rewards_updated += 1
+        print "Total rewards updated: %d" % rewards_updated
@@ -0,0 +1,20 @@
+from calendar import timegm
+
+from django.utils.http import http_date, quote_etag
+
+
+class ConditionalGetMiddleware(object):
+    """ Adds the ETag and Last-Modified headers of zipfelchappe views to the
+        page response. The views render into a feincms page and can't set
+        response headers themselves. """
+
+    def process_response(self, request, response):
+        validators = getattr(request, 'zipfelchappe_validators', None)
+        if validators and response.status_code == 200:
+            etag, last_modified = validators
+            if not response.has_header('ETag'):
+                response['ETag'] = quote_etag(etag)
+            if not response.has_header('Last-Modified'):
+                response['Last-Modified'] = http_date(
+                    timegm(last_modified.utctimetuple()))
+        return response
@@ -1,14 +1,18 @@
 from __future__ import unicode_literals, absolute_import
+import ast
+import json
 from datetime import timedelta
 
 from django import forms
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 
-from django.db import models
-from django.db.models import signals, Sum
+from django.db import connection, models
+from django.http import QueryDict
+from django.db.models import signals, Count, F, Q, Sum
 from django.db.models.fields import AutoField
 from django.db.models.fields.related import RelatedField
 
@@ -27,8 +31,13 @@ from feincms.utils.queryset_transform import TransformQuerySet
 from feincms.content.application import models as app_models
 
 from .app_settings import CURRENCIES, PAYMENT_PROVIDERS, BACKER_PROFILE, ROOT_URLS
+from .app_settings import REWARD_HOLD_MINUTES
 from .base import CreateUpdateModel
+from .cache import invalidate_project_lists, invalidate_project
+from .cache import invalidate_project_of, invalidate_project_funding
 from .fields import CurrencyField
+from .signals import funding_changed, send_funding_changed
+from .utils import LRUCache, atomic
 import warnings
 
 CURRENCY_CHOICES = list(((cur, cur) for cur in CURRENCIES))
@@ -54,6 +63,66 @@ class TranslatedMixin(object):
             return self._translation
 
 
+def load_translations(objects, lang=None):
+    """ Fetches the translations of a list of objects of the same model with
+        one query and caches them as the objects translation. Objects without
+        a translation cache themselves, so the lookup is not repeated. """
+    if not objects:
+        return
+
+    model = type(objects[0])
+    for obj in objects:
+        obj._translation = obj
+
+    descriptor = getattr(model, 'translations', None)
+    if descriptor is None:  # zipfelchappe.translations is not installed
+        return
+
+    filters = {'translation_of__in': [obj.pk for obj in objects]}
+    if 'project' in model._meta.get_all_field_names():
+        filters['translation__lang'] = lang or get_language()
+    else:
+        filters['lang'] = lang or get_language()
+
+    translations = descriptor.related.model._default_manager.filter(**filters)
+    by_object = dict((t.translation_of_id, t) for t in translations)
+    for obj in objects:
+        obj._translation = by_object.get(obj.pk, obj)
+
+
+class TranslatedQuerySet(TransformQuerySet):
+
+    def with_translations(self, lang=None):
+        """ Loads the translations of all objects in one additional query
+            once the queryset is evaluated. """
+        lang = lang or get_language()
+        return self.transform(lambda objects: load_translations(objects, lang))
+
+
+class TranslatedManager(models.Manager):
+
+    def get_queryset(self):
+        return TranslatedQuerySet(self.model, using=self._db)
+
+    def with_translations(self, lang=None):
+        return self.get_queryset().with_translations(lang)
+
+
+def protect_counter_fields(instance, kwargs):
+    """ Excludes the COUNTER_FIELDS of an instance from an update. Counters
+        are changed concurrently with F() expressions and must never be
+        overwritten with the stale values of a loaded instance. """
+    if not instance._state.adding and not kwargs.get('force_insert') \
+            and kwargs.get('update_fields') is None:
+        kwargs['update_fields'] = [f.name for f in
+            instance._meta.concrete_fields if not f.primary_key
+            and f.name not in instance.COUNTER_FIELDS]
+
+
+class RewardUnavailable(Exception):
+    pass
+
+
 class Backer(models.Model):
     """ The base model for all project backers with some transient attributes
         to overwrite user attributes. This is only necessary to support offline
@@ -143,6 +212,17 @@ class Pledge(CreateUpdateModel, TranslatedMixin):
         (FAILED, _('Failed')),
     )
 
+    # Status changes that notifications and payment collection may make.
+    # Notifications can arrive late or more than once and must never move a
+    # pledge back, e.g. from authorized to unauthorized or from paid to
+    # anything else. Late payments of failed collections are still accepted.
+    TRANSITIONS = {
+        UNAUTHORIZED: (FAILED, AUTHORIZED, PAID),
+        FAILED: (PAID,),
+        AUTHORIZED: (FAILED, PAID),
+        PAID: (),
+    }
+
     backer = models.ForeignKey('Backer', verbose_name=_('backer'),
         related_name='pledges', blank=True, null=True)
 
@@ -163,15 +243,30 @@ class Pledge(CreateUpdateModel, TranslatedMixin):
     provider = models.CharField(_('payment provider'), max_length=20,
         choices=PAYMENT_PROVIDERS, default=DEFAULT_PAYMENT_PROVIDER)
 
+    # Legacy storage of extra data, see PledgeExtraValue
     extradata = models.TextField(_('extra'), blank=True)
 
     # The internal status of the pledge, common for all payment providers
     status = models.PositiveIntegerField(_('status'), choices=STATUS_CHOICES,
             default=UNAUTHORIZED)
 
+    # Whether this pledge holds one unit of the reward, see Reward.claimed
+    reward_claimed = models.BooleanField(default=False, editable=False)
+
     class Meta:
         verbose_name = _('pledge')
         verbose_name_plural = _('pledges')
+        index_together = (('project', 'created'), ('status', 'project'))
+
+    def __init__(self, *args, **kwargs):
+        super(Pledge, self).__init__(*args, **kwargs)
+        # What this pledge contributed to the project counters when loaded
+        if self.pk is None:
+            self._counted = (self.project_id, 0, 0, 0)
+            self._loaded_reward_id = None
+        else:
+            self._counted = self.funding_contribution()
+            self._loaded_reward_id = self.reward_id
 
     def __unicode__(self):
         return u'Pledge of %d %s from %s to %s' % \
@@ -179,7 +274,141 @@ class Pledge(CreateUpdateModel, TranslatedMixin):
 
     def save(self, *args, **kwargs):
         self.currency = self.project.currency
-        super(Pledge, self).save(*args, **kwargs)
+        with atomic():
+            self.update_reward_claim()
+            super(Pledge, self).save(*args, **kwargs)
+            self.update_funding_counters()
+        self._loaded_reward_id = self.reward_id
+
+    def update_reward_claim(self):
+        """ Takes or gives back one unit of the selected reward according to
+            the pledge status. Raises RewardUnavailable if a reward is newly
+            selected that has been given away completely in the meantime. """
+        claimed_id = self._loaded_reward_id if self.reward_claimed else None
+
+        if not self.reward_id or self.status == Pledge.FAILED:
+            wanted = False
+        elif self.status >= Pledge.AUTHORIZED or self.reward_claimed:
+            wanted = True
+        else:
+            # New or changed selection. Unauthorized pledges that are saved
+            # again do not renew an expired hold.
+            wanted = (self.pk is None or
+                      self.reward_id != self._loaded_reward_id)
+
+        release = claimed_id and (not wanted or claimed_id != self.reward_id)
+        holds = self.reward_claimed and not release
+
+        if wanted and not holds:
+            # Authorized payments always get their reward
+            check = self.status < Pledge.AUTHORIZED
+            if not self.reward.claim(check=check):
+                raise RewardUnavailable(self.reward)
+            holds = True
+
+        if release:
+            Reward.objects.release(claimed_id, self.project_id)
+
+        self.reward_claimed = holds
+
+    def release_reward(self):
+        """ Gives back the reward held by an unauthorized pledge, e.g. if
+            the backer canceled the payment or the hold expired. """
+        with atomic():
+            released = Pledge.objects.filter(pk=self.pk, reward_claimed=True,
+                status__lt=Pledge.AUTHORIZED).update(reward_claimed=False)
+            if released:
+                Reward.objects.release(self.reward_id, self.project_id)
+        if released:
+            self.reward_claimed = False
+        return bool(released)
+
+    @property
+    def extra_data(self):
+        """ The answers to the extra fields of the project as a dict. Use
+            prefetch_related('extra_values') when listing pledges. """
+        data = dict((v.name, v.value) for v in self.extra_values.all())
+        if not data and self.extradata:
+            # Not converted yet, see the convert_extradata command
+            try:
+                data = ast.literal_eval(self.extradata)
+            except (SyntaxError, ValueError):
+                pass
+        return data
+
+    def set_extra_data(self, data):
+        """ Replaces the stored answers to the extra fields """
+        fields = dict((slugify(f.name), f.pk)
+            for f in ExtraField.objects.filter(project=self.project_id))
+        with atomic():
+            self.extra_values.all().delete()
+            PledgeExtraValue.objects.bulk_create([
+                PledgeExtraValue(pledge=self, field_id=fields.get(name),
+                    name=name, value=unicode(value))
+                for name, value in data.items()
+            ])
+            if self.extradata:
+                self.extradata = ''
+                Pledge.objects.filter(pk=self.pk).update(extradata='')
+
+    def update_status(self, status):
+        """ Changes the status as reported by a payment notification. The
+            pledge is locked and reloaded first. Only the changes in
+            TRANSITIONS are made, as notifications can arrive late or more
+            than once. Returns whether the status has been changed. """
+        with atomic():
+            pledge = Pledge.objects.select_for_update().get(pk=self.pk)
+            changed = status in Pledge.TRANSITIONS.get(pledge.status, ())
+            if changed:
+                pledge.status = status
+                pledge.save()
+        self.status = pledge.status
+        self.reward_claimed = pledge.reward_claimed
+        self._counted = pledge._counted
+        return changed
+
+    def funding_contribution(self):
+        """ Returns the project id and the amount, backer and public backer
+            counts this pledge adds to the funding counters of its project """
+        if self.status >= Pledge.AUTHORIZED:
+            public = 0 if self.anonymously else 1
+            return self.project_id, self.amount or 0, 1, public
+        else:
+            return self.project_id, 0, 0, 0
+
+    def update_funding_counters(self, deleted=False):
+        """ Applies the changes of this pledge since it was loaded or last
+            saved to the stored funding counters of the project """
+        previous = self._counted
+        current = (self.project_id, 0, 0, 0) if deleted \
+            else self.funding_contribution()
+
+        changes = {}
+        for sign, (project_id, amount, count, public) in \
+                ((-1, previous), (1, current)):
+            totals = changes.setdefault(project_id, [0, 0, 0])
+            totals[0] += sign * amount
+            totals[1] += sign * count
+            totals[2] += sign * public
+
+        for project_id, (amount, count, public) in changes.items():
+            if project_id is None or not (amount or count or public):
+                continue
+            Project.objects.filter(pk=project_id).update(
+                achieved_amount=F('achieved_amount') + amount,
+                authorized_count=F('authorized_count') + count,
+                public_backer_count=F('public_backer_count') + public,
+                modified=now(),
+            )
+            # Keep an already loaded project instance in sync as well
+            project = getattr(self, '_project_cache', None)
+            if project is not None and project.pk == project_id:
+                project.achieved_amount += amount
+                project.authorized_count += count
+                project.public_backer_count += public
+            send_funding_changed(Project, project_id)
+
+        self._counted = current
 
     @property
     def amount_display(self):
@@ -208,6 +437,21 @@ class Pledge(CreateUpdateModel, TranslatedMixin):
         return related_values
 
 
+class RewardManager(TranslatedManager):
+
+    def release(self, reward_id, project_id):
+        """ Gives one claimed unit of a reward of the project back """
+        if self.filter(pk=reward_id, claimed__gt=0).update(
+                claimed=F('claimed') - 1):
+            send_funding_changed(Project, project_id)
+
+    def expired_holds(self):
+        """ Returns the unauthorized pledges whose reward hold expired """
+        expiry = now() - timedelta(minutes=REWARD_HOLD_MINUTES)
+        return Pledge.objects.filter(reward_claimed=True,
+            status__lt=Pledge.AUTHORIZED, modified__lt=expiry)
+
+
 class Reward(CreateUpdateModel, TranslatedMixin):
     """ A reward is a give-away for backers that pledge a certain amount.
         Rewards may be limited to a maximum number of backers. """
@@ -224,6 +468,14 @@ class Reward(CreateUpdateModel, TranslatedMixin):
         help_text=_('How many times can this award be given away? Leave ' +
             'empty to means unlimited'))
 
+    # Number of pledges holding this reward, maintained by Pledge.save()
+    claimed = models.PositiveIntegerField(_('claimed'), default=0,
+        editable=False)
+
+    COUNTER_FIELDS = ('claimed',)
+
+    objects = RewardManager()
+
     class Meta:
         verbose_name = _('reward')
         verbose_name_plural = _('rewards')
@@ -232,8 +484,13 @@ class Reward(CreateUpdateModel, TranslatedMixin):
     def __unicode__(self):
         return u'%s on %s (%d)' % (self.minimum, self.project, self.pk)
 
+    def save(self, *args, **kwargs):
+        protect_counter_fields(self, kwargs)
+        return super(Reward, self).save(*args, **kwargs)
+
     def clean(self):
-        if self.id and self.quantity and self.quantity < self.awarded:
+        # Units held for unauthorized pledges count as well
+        if self.id and self.quantity and self.quantity < self.claimed:
             raise ValidationError(_('Cannot reduce quantity to a lower value ' +
                 'than what was already promised to backers'))
 
@@ -247,7 +504,26 @@ class Reward(CreateUpdateModel, TranslatedMixin):
 
     @property
     def available(self):
-        return self.quantity - self.awarded
+        return self.quantity - self.claimed
+
+    def claim(self, check=True):
+        """ Atomically takes one unit of this reward. With check set, this
+            fails and returns False if the reward is given away completely. """
+        rewards = Reward.objects.filter(pk=self.pk)
+        if check:
+            rewards = rewards.filter(Q(quantity__isnull=True) | Q(quantity=0) |
+                                     Q(claimed__lt=F('quantity')))
+        if rewards.update(claimed=F('claimed') + 1):
+            self.claimed += 1
+            send_funding_changed(Project, self.project_id)
+            return True
+        return False
+
+    def update_claimed(self):
+        """ Recalculates the claimed counter from the pledges """
+        self.claimed = self.pledges.filter(reward_claimed=True).count()
+        Reward.objects.filter(pk=self.pk).update(claimed=self.claimed)
+        send_funding_changed(Project, self.project_id)
 
     @property
     def is_available(self):
@@ -306,6 +582,9 @@ class Update(CreateUpdateModel, TranslatedMixin):
     status = models.CharField(_('status'), max_length=20,
         choices=STATUS_CHOICES, default='draft')
     mails_sent = models.BooleanField(editable=False, default=False)
+    # Backer pk up to which notification mails have been sent, None if no
+    # mails are scheduled. See the send_update_mails management command.
+    mails_checkpoint = models.PositiveIntegerField(editable=False, null=True)
 
     image = models.ImageField(_('image'), blank=True, null=True,
         upload_to=update_upload_to)
@@ -319,14 +598,29 @@ class Update(CreateUpdateModel, TranslatedMixin):
     attachment = models.FileField(_('attachment'), blank=True, null=True,
         upload_to=update_upload_to)
 
+    objects = TranslatedManager()
+
     class Meta:
         verbose_name = _('update')
         verbose_name_plural = _('updates')
         ordering = ('-created',)
 
+    def __init__(self, *args, **kwargs):
+        super(Update, self).__init__(*args, **kwargs)
+        self._loaded_status = self.status if self.pk else None
+
     def __unicode__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # Notify the backers once the update gets published
+        if (self.status == self.STATUS_PUBLISHED and
+                self._loaded_status != self.STATUS_PUBLISHED and
+                not self.mails_sent and self.mails_checkpoint is None):
+            self.mails_checkpoint = 0
+        super(Update, self).save(*args, **kwargs)
+        self._loaded_status = self.status
+
     @app_models.permalink
     def get_absolute_url(self):
         return ('zipfelchappe_update_detail', ROOT_URLS,
@@ -363,6 +657,8 @@ class MailTemplate(CreateUpdateModel, TranslatedMixin):
 
     template = models.TextField(_('template'))  # no richtext here
 
+    objects = TranslatedManager()
+
     class Meta:
         verbose_name = _('email')
         verbose_name_plural = _('emails')
@@ -372,6 +668,197 @@ class MailTemplate(CreateUpdateModel, TranslatedMixin):
         return '%s mail for %s' % (self.action, self.project)
 
 
+class QueuedMail(CreateUpdateModel):
+    """ An outgoing mail. Mails are sent in batches by the send_queued_mails
+        management command and retried with an increasing delay if sending
+        fails. Mails that fail too often are kept with status failed. """
+
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (QUEUED, _('Queued')),
+        (SENDING, _('Sending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    )
+
+    subject = models.CharField(_('subject'), max_length=255)
+
+    message = models.TextField(_('message'))
+
+    from_email = models.CharField(_('from'), max_length=255)
+
+    recipient = models.EmailField(_('recipient'), max_length=254)
+
+    status = models.CharField(_('status'), max_length=20,
+        choices=STATUS_CHOICES, default=QUEUED)
+
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+
+    next_attempt = models.DateTimeField(_('next attempt'), default=now)
+
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta:
+        verbose_name = _('queued mail')
+        verbose_name_plural = _('queued mails')
+        index_together = (('status', 'next_attempt'),)
+
+    def __unicode__(self):
+        return u'%s to %s' % (self.subject, self.recipient)
+
+
+class NotificationRejected(Exception):
+    """ Raised by notification processors for messages that are invalid and
+        should not be retried """
+    pass
+
+
+class PaymentNotification(CreateUpdateModel):
+    """ A notification (IPN) from a payment provider. The provider views only
+        store the message, it is applied later by the process_notifications
+        management command. """
+
+    NEW = 'new'
+    PROCESSED = 'processed'
+    DUPLICATE = 'duplicate'
+    REJECTED = 'rejected'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (NEW, _('New')),
+        (PROCESSED, _('Processed')),
+        (DUPLICATE, _('Duplicate')),
+        (REJECTED, _('Rejected')),
+        (FAILED, _('Failed')),
+    )
+
+    provider = models.CharField(_('provider'), max_length=20)
+
+    # Notifications with the same key are applied in the order received
+    key = models.CharField(_('key'), max_length=100, blank=True)
+
+    # Status of the payment according to the provider
+    reported_status = models.CharField(_('reported status'), max_length=50,
+        blank=True)
+
+    payload = models.TextField(_('payload'))
+
+    payload_hash = models.CharField(_('payload hash'), max_length=40)
+
+    status = models.CharField(_('status'), max_length=20,
+        choices=STATUS_CHOICES, default=NEW)
+
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+
+    next_attempt = models.DateTimeField(_('next attempt'), default=now)
+
+    last_error = models.TextField(_('last error'), blank=True)
+
+    class Meta:
+        verbose_name = _('payment notification')
+        verbose_name_plural = _('payment notifications')
+        index_together = (('status', 'next_attempt'),)
+
+    def __unicode__(self):
+        return u'%s notification %s' % (self.provider, self.key)
+
+    @property
+    def data(self):
+        """ The POST data of the notification """
+        return QueryDict(self.payload.encode('utf-8'))
+
+
+class ProcessedNotification(models.Model):
+    """ Ledger of applied payment notifications. Providers resend their
+        notifications, this is used to apply each one only once. """
+
+    provider = models.CharField(_('provider'), max_length=20)
+
+    key = models.CharField(_('key'), max_length=100)
+
+    status = models.CharField(_('status'), max_length=50)
+
+    payload_hash = models.CharField(_('payload hash'), max_length=40)
+
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('processed notification')
+        verbose_name_plural = _('processed notifications')
+        unique_together = (('provider', 'key', 'status', 'payload_hash'),)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.provider, self.key, self.status)
+
+
+class ExportJob(CreateUpdateModel):
+    """ A csv export that is too large to be streamed to the browser. It is
+        written in chunks by the run_export_jobs management command. """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (QUEUED, _('Queued')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    user = models.ForeignKey(User, verbose_name=_('user'), blank=True,
+        null=True, on_delete=models.SET_NULL)
+
+    # app_label.model_name of the exported model
+    model = models.CharField(_('model'), max_length=100)
+
+    # Primary keys of the exported objects as sorted JSON list
+    object_ids = models.TextField(_('objects'))
+
+    status = models.CharField(_('status'), max_length=20,
+        choices=STATUS_CHOICES, default=QUEUED)
+
+    file = models.FileField(_('file'), upload_to='exports', blank=True)
+
+    rows = models.PositiveIntegerField(_('rows'), default=0)
+
+    # Primary key of the last exported object and file size after it
+    checkpoint = models.PositiveIntegerField(null=True, editable=False)
+    size = models.PositiveIntegerField(default=0, editable=False)
+
+    error = models.TextField(_('error'), blank=True)
+
+    class Meta:
+        verbose_name = _('export')
+        verbose_name_plural = _('exports')
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return u'%s export %s' % (self.model, self.pk)
+
+    def get_model(self):
+        return models.get_model(*self.model.split('.'))
+
+    def get_object_ids(self):
+        return json.loads(self.object_ids)
+
+    def get_queryset(self):
+        """ Returns the exported objects that still exist """
+        return self.get_model()._default_manager.filter(
+            pk__in=self.get_object_ids())
+
+    def set_queryset(self, queryset):
+        opts = queryset.model._meta
+        self.model = '%s.%s' % (opts.app_label, opts.object_name)
+        self.object_ids = json.dumps(sorted(
+            queryset.values_list('pk', flat=True)))
+
+
 class ExtraField(models.Model):
     """ Extra fields are used to request additional per pledge """
 
@@ -384,6 +871,8 @@ class ExtraField(models.Model):
         ('select', _('select'), curry(forms.ChoiceField, required=False)),
     ]
 
+    FIELD_CLASSES = dict((r[0], r[2]) for r in FIELD_TYPES)
+
     project = models.ForeignKey('zipfelchappe.Project',
         related_name='extrafields')
 
@@ -423,8 +912,7 @@ class ExtraField(models.Model):
         return tuple(choices)
 
     def get_type(self, **kwargs):
-        types = dict((r[0], r[2]) for r in self.FIELD_TYPES)
-        return types[self.type](**kwargs)
+        return self.FIELD_CLASSES[self.type](**kwargs)
 
     def add_formfield(self, fields, form):
         fields[slugify(self.name)] = self.formfield()
@@ -439,10 +927,61 @@ class ExtraField(models.Model):
         return self.get_type(**kwargs)
 
 
-class ProjectManager(models.Manager):
+class PledgeExtraValue(models.Model):
+    """ The answer of a backer to an extra field of the project """
+
+    pledge = models.ForeignKey('Pledge', related_name='extra_values')
+
+    field = models.ForeignKey('ExtraField', related_name='values',
+        blank=True, null=True, on_delete=models.SET_NULL)
+
+    # Form field name, kept if the extra field gets deleted
+    name = models.CharField(_('name'), max_length=100, db_index=True)
+
+    value = models.TextField(_('value'), blank=True)
+
+    class Meta:
+        verbose_name = _('extra value')
+        verbose_name_plural = _('extra values')
+        unique_together = (('pledge', 'name'),)
+        ordering = ('name',)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.value)
+
+
+class ProjectQuerySet(TranslatedQuerySet):
+
+    def with_stats(self):
+        """ Annotates the number of published updates and joins the author,
+            so that a list of projects renders with a constant number of
+            queries. Funding figures come from the stored counters. """
+        qn = connection.ops.quote_name
+        update_count = ('SELECT COUNT(*) FROM %(update)s'
+            ' WHERE %(update)s.%(project_id)s = %(project)s.%(pk)s'
+            ' AND %(update)s.%(status)s = %%s') % {
+            'update': qn(Update._meta.db_table),
+            'project_id': qn(Update._meta.get_field('project').column),
+            'status': qn(Update._meta.get_field('status').column),
+            'project': qn(self.model._meta.db_table),
+            'pk': qn(self.model._meta.pk.column),
+        }
+        queryset = self.extra(
+            select={'update_count': update_count},
+            select_params=(Update.STATUS_PUBLISHED,),
+        )
+        if 'author' in self.model._meta.get_all_field_names():
+            queryset = queryset.select_related('author')
+        return queryset
+
+
+class ProjectManager(TranslatedManager):
 
     def get_queryset(self):
-        return TransformQuerySet(self.model, using=self._db)
+        return ProjectQuerySet(self.model, using=self._db)
+
+    def with_stats(self):
+        return self.get_queryset().with_stats()
 
     def online(self):
         return self.filter(start__lte=now)
@@ -450,11 +989,15 @@ class ProjectManager(models.Manager):
     def funding(self):
         return self.online().filter(end__gte=now)
 
-    def billable(self):
-        """ Returns a list of projects that are successfully financed
-            (payments can be collected) """
-        ending = self.filter(end__lte=now())
-        return list([project for project in ending if project.is_financed])
+    def billable(self, exclude_processed=False):
+        """ Returns the ended projects that are successfully financed
+            (payments can be collected). With exclude_processed, projects
+            without authorized pledges left to collect are skipped. """
+        billable = self.filter(end__lte=now(), achieved_amount__gte=F('goal'))
+        if exclude_processed:
+            collectable = Pledge.objects.filter(status=Pledge.AUTHORIZED)
+            billable = billable.filter(pk__in=collectable.values('project'))
+        return billable
 
 
 def teaser_img_upload_to(instance, filename):
@@ -501,6 +1044,28 @@ class Project(Base, TranslatedMixin):
 
     teaser_text = RichTextField(_('text'), blank=True)
 
+    # Funding counters, maintained by Pledge.save(). Run the management command
+    # update_funding_counters to recalculate them from scratch.
+    achieved_amount = CurrencyField(_('achieved amount'), max_digits=10,
+        decimal_places=2, default=0, editable=False)
+
+    authorized_count = models.PositiveIntegerField(_('authorized pledges'),
+        default=0, editable=False)
+
+    public_backer_count = models.PositiveIntegerField(_('public backers'),
+        default=0, editable=False)
+
+    # Bumped whenever an extra field of the project changes, see extraform()
+    extrafields_version = models.PositiveIntegerField(default=0,
+        editable=False)
+
+    COUNTER_FIELDS = ('achieved_amount', 'authorized_count',
+                      'public_backer_count', 'extrafields_version')
+
+    # Changes with everything shown on the project pages, including funding,
+    # rewards, updates and comments. Used to answer conditional requests.
+    modified = models.DateTimeField(_('modified'), auto_now=True)
+
     objects = ProjectManager()
 
     class Meta:
@@ -519,6 +1084,7 @@ class Project(Base, TranslatedMixin):
             except IndexError:
                 self.position = 0
 
+        protect_counter_fields(self, kwargs)
         return super(Project, self).save(*args, **kwargs)
 
     def __unicode__(self):
@@ -589,14 +1155,30 @@ class Project(Base, TranslatedMixin):
     def has_pledges(self):
         return self.pledges.count() > 0
 
-    @cached_property
+    @property
     def achieved(self):
         """
         Returns the amount of money raised
         :return: Amount raised
         """
-        amount = self.authorized_pledges.aggregate(Sum('amount'))
-        return amount['amount__sum'] or 0
+        return self.achieved_amount
+
+    def update_funding_counters(self):
+        """ Recalculates the stored funding counters from the pledges """
+        authorized = self.pledges.filter(status__gte=Pledge.AUTHORIZED)
+        totals = authorized.aggregate(amount=Sum('amount'), count=Count('id'))
+
+        self.achieved_amount = totals['amount'] or 0
+        self.authorized_count = totals['count']
+        self.public_backer_count = authorized.filter(anonymously=False).count()
+
+        Project.objects.filter(pk=self.pk).update(
+            achieved_amount=self.achieved_amount,
+            authorized_count=self.authorized_count,
+            public_backer_count=self.public_backer_count,
+            modified=now(),
+        )
+        send_funding_changed(Project, self.pk)
 
     @property
     def percent(self):
@@ -633,6 +1215,7 @@ class Project(Base, TranslatedMixin):
 
     @cached_property
     def update_count(self):
+        # Annotated by ProjectQuerySet.with_stats() if available
         return self.updates.filter(status='published').count()
 
     @cached_property
@@ -643,13 +1226,81 @@ class Project(Base, TranslatedMixin):
         )
 
     def extraform(self):
-        """ Returns additional form required to pledge to this project """
-        fields = SortedDict()
+        """ Returns additional form required to pledge to this project.
+            Form classes are cached per process until the extra fields of
+            the project change. """
+        key = (self.pk, self.extrafields_version)
+        form_class = extraform_cache.get(key)
+
+        if form_class is None:
+            fields = SortedDict()
+            for field in self.extrafields.all():
+                field.add_formfield(fields, self)
+            form_class = type(b'Form%s' % self.pk, (forms.Form,), fields)
+
+            # Older versions of this project can't be requested anymore
+            extraform_cache.discard(lambda k: k[0] == self.pk)
+            extraform_cache.set(key, form_class)
+
+        return form_class
+
+
+extraform_cache = LRUCache(100)
+
+
+def extrafield_changed(sender, instance, **kwargs):
+    """ Invalidates the cached extra form of the project """
+    Project.objects.filter(pk=instance.project_id).update(
+        extrafields_version=F('extrafields_version') + 1)
+    # Keep an already loaded project in sync
+    project = getattr(instance, '_project_cache', None)
+    if project is not None:
+        project.extrafields_version += 1
+
+
+signals.post_save.connect(extrafield_changed, sender=ExtraField)
+signals.post_delete.connect(extrafield_changed, sender=ExtraField)
+
+
+def pledge_post_delete(sender, instance, **kwargs):
+    instance.update_funding_counters(deleted=True)
+    if instance.reward_claimed and instance._loaded_reward_id:
+        Reward.objects.release(instance._loaded_reward_id,
+            instance.project_id)
+
+
+signals.post_delete.connect(pledge_post_delete, sender=Pledge)
+
+for signal in (signals.post_save, signals.post_delete):
+    for model in (Project, Category, Update):
+        signal.connect(invalidate_project_lists, sender=model)
+funding_changed.connect(invalidate_project_lists)
+
+
+def touch_project(sender, instance, **kwargs):
+    """ Updates the modification time of the project of a changed object """
+    Project.objects.filter(pk=instance.project_id).update(modified=now())
+
+
+def touch_commented_project(sender, instance, **kwargs):
+    if instance.content_type_id == \
+            ContentType.objects.get_for_model(Project).pk:
+        Project.objects.filter(pk=instance.object_pk).update(modified=now())
+
+
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(touch_project, sender=Reward)
+    signal.connect(touch_project, sender=Update)
 
-        for field in self.extrafields.all():
-            field.add_formfield(fields, self)
+if 'django.contrib.comments' in settings.INSTALLED_APPS:
+    from django.contrib.comments.models import Comment
 
-        return type(b'Form%s' % self.pk, (forms.Form,), fields)
+    for signal in (signals.post_save, signals.post_delete):
+        signal.connect(touch_commented_project, sender=Comment)
 
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(invalidate_project, sender=Project)
+    signal.connect(invalidate_project_of, sender=Reward)
+funding_changed.connect(invalidate_project_funding)
 
 signals.post_syncdb.connect(check_db_schema(Project, __name__), weak=False)
@@ -0,0 +1,107 @@
+from __future__ import unicode_literals, absolute_import
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.timezone import is_aware, make_aware, utc
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class KeysetPage(object):
+    """ One page of a KeysetPaginator with cursors to its neighbours """
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if self.object_list:
+            return make_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.object_list:
+            return make_cursor(self.object_list[0])
+
+
+def make_cursor(obj):
+    created = obj.created
+    if is_aware(created):
+        created = created.astimezone(utc)
+    return '%s-%d' % (created.strftime(CURSOR_DATE_FORMAT), obj.pk)
+
+
+def parse_cursor(cursor):
+    """ Returns (created, pk) of a cursor, raises ValueError if invalid.
+        Without USE_TZ, created is naive like the stored timestamps. """
+    timestamp, pk = cursor.split('-')
+    created = datetime.strptime(timestamp, CURSOR_DATE_FORMAT)
+    if settings.USE_TZ:
+        created = make_aware(created, utc)
+    return created, int(pk)
+
+
+class KeysetPaginator(object):
+    """ Pages through a queryset in (created, id) order. Instead of counting
+        and skipping rows with OFFSET, every page starts right after (or
+        before) the last row seen, so deep pages are as cheap as the first
+        one. Requires an index on the created column to be efficient. """
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def page(self, after=None, before=None):
+        """ Returns the page following the cursor ``after`` or preceding the
+            cursor ``before``. Invalid cursors return the first page. """
+        cursor = before or after
+        if not cursor:
+            return self._page_after(None, None)
+        try:
+            created, pk = parse_cursor(cursor)
+        except ValueError:
+            return self._page_after(None, None)
+
+        if before:
+            return self._page_before(created, pk)
+        return self._page_after(created, pk)
+
+    def _page_after(self, created, pk):
+        queryset = self.queryset.order_by('created', 'id')
+        if created is not None:
+            queryset = queryset.filter(
+                Q(created__gt=created) | Q(created=created, id__gt=pk))
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_next = len(object_list) > self.per_page
+        return KeysetPage(object_list[:self.per_page], has_next,
+            has_previous=created is not None)
+
+    def _page_before(self, created, pk):
+        queryset = self.queryset.order_by('-created', '-id').filter(
+            Q(created__lt=created) | Q(created=created, id__lt=pk))
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_previous = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        object_list.reverse()
+        return KeysetPage(object_list, has_next=True,
+            has_previous=has_previous)
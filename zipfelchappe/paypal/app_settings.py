@@ -12,7 +12,10 @@ Needs the following settings to work correctly::
         'RECEIVERS': [{
             'email': 'your@paypalid.ch',
             'percent': 100,
-        }]
+        }],
+        'RATE_LIMIT': 5, # Max. API requests per second when collecting
+        'TIMEOUT': (5, 30), # Seconds to connect and to wait for an answer
+        'RETRIES': 2,
     }
 """
 from django.conf import settings
@@ -25,6 +28,9 @@ PAYPAL = {
     'APPLICATIONID': None,
     'LIVE': False,
     'RECEIVERS': [],
+    'RATE_LIMIT': 5,
+    'TIMEOUT': (5, 30),
+    'RETRIES': 2,
 }
 
 PAYPAL.update(getattr(settings, 'ZIPFELCHAPPE_PAYPAL', {}))
@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 
 from zipfelchappe.paypal.tasks import process_payments
@@ -6,6 +8,11 @@ from zipfelchappe.paypal.tasks import process_payments
 class Command(BaseCommand):
     help = 'Collect all paypal payments for finished projects (cronjob)'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of payment requests sent to paypal concurrently'),
+    )
+
     def handle(self, *args, **options):
-        pledges_processed = process_payments()
+        pledges_processed = process_payments(workers=options['workers'])
         print "Total pledges processed: %d" % pledges_processed
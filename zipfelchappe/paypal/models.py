@@ -7,6 +7,21 @@ from zipfelchappe.base import CreateUpdateModel
 
 class Preapproval(CreateUpdateModel):
 
+    # These are the statuses of preapprovals
+    CREATED = 'CREATED'
+    ACTIVE = 'ACTIVE'
+    CANCELED = 'CANCELED'
+    DEACTIVED = 'DEACTIVED'
+
+    # How far a preapproval has progressed, notifications for lower ranks
+    # are late or replayed. Unknown statuses have rank 0.
+    STATUS_RANKS = {
+        CREATED: 0,
+        ACTIVE: 1,
+        CANCELED: 2,
+        DEACTIVED: 2,
+    }
+
     pledge = models.OneToOneField('zipfelchappe.Pledge',
         related_name='paypal_preapproval')
 
@@ -29,6 +44,10 @@ class Preapproval(CreateUpdateModel):
     def __unicode__(self):
         return self.key
 
+    @classmethod
+    def status_rank(cls, status):
+        return cls.STATUS_RANKS.get(status, 0)
+
 
 class Payment(CreateUpdateModel):
 
@@ -41,6 +60,18 @@ class Payment(CreateUpdateModel):
     PROCESSING = 'PROCESSING'
     PENDING = 'PENDING'
 
+    # How far a payment has progressed, notifications for lower ranks are
+    # late or replayed. Unknown statuses have rank 0.
+    STATUS_RANKS = {
+        CREATED: 0,
+        PENDING: 1,
+        PROCESSING: 1,
+        COMPLETED: 2,
+        INCOMPLETE: 2,
+        ERROR: 2,
+        REVERSALERROR: 2,
+    }
+
     key = models.CharField(_('key'), max_length=20, blank=True)
 
     preapproval = models.ForeignKey('Preapproval', related_name='payments')
@@ -55,3 +86,7 @@ class Payment(CreateUpdateModel):
 
     def __unicode__(self):
         return self.key
+
+    @classmethod
+    def status_rank(cls, status):
+        return cls.STATUS_RANKS.get(status, 0)
@@ -8,9 +8,14 @@ https://developer.paypal.com/docs/classic/api/#ap
 import json
 import requests
 import logging
+import threading
+import time
 from datetime import datetime
 from decimal import Decimal
 
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
@@ -20,6 +25,7 @@ from django.utils.translation import ugettext as _
 from feincms.content.application.models import app_reverse
 
 from . import app_settings as settings
+from ..app_settings import ROOT_URLS
 
 PP_REQ_HEADERS = {
     'X-PAYPAL-SECURITY-USERID': settings.PAYPAL['USERID'],
@@ -50,25 +56,91 @@ def paypal_redirect(params):
     return redirect('%s?%s' % (PP_CMD_URL, params.urlencode()))
 
 
-def verify_ipn_message(data):
-    verify_params = {'cmd': '_notify-validate'}
-    verify_params.update(data)
+class PaypalClient(object):
+    """
+    Sends all requests to paypal over one session, so connections are kept
+    alive and reused. Requests time out after ZIPFELCHAPPE_PAYPAL['TIMEOUT']
+    (connect, read) seconds. Failed connections are retried, read errors only
+    for GET requests, as POST requests to the API are not idempotent.
+
+    Requests, errors and the total time spent are counted per endpoint in
+    stats.
+    """
+
+    def __init__(self, api_url=None, cmd_url=None, timeout=None, retries=None):
+        self.api_url = api_url or PP_API_URL
+        self.cmd_url = cmd_url or PP_CMD_URL
+        self.timeout = timeout or settings.PAYPAL['TIMEOUT']
+
+        if retries is None:
+            retries = settings.PAYPAL['RETRIES']
+        adapter = HTTPAdapter(max_retries=Retry(total=retries,
+            backoff_factor=0.5, method_whitelist=frozenset(['GET'])))
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def request(self, endpoint, method, url, **kwargs):
+        """ Sends a request and counts it in the stats of endpoint """
+        start = time.time()
+        try:
+            response = self.session.request(method, url,
+                timeout=self.timeout, **kwargs)
+            response.raise_for_status()
+        except requests.RequestException:
+            self.count(endpoint, time.time() - start, error=True)
+            raise
+        self.count(endpoint, time.time() - start)
+        return response
+
+    def count(self, endpoint, duration, error=False):
+        with self._lock:
+            stats = self.stats.setdefault(endpoint,
+                {'requests': 0, 'errors': 0, 'time': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['time'] += duration
+
+    def call(self, operation, data):
+        """ Calls an adaptive payments operation and returns the parsed
+            answer, which contains a list of errors if the call failed """
+        response = self.request(operation, 'POST',
+            '%s/AdaptivePayments/%s' % (self.api_url, operation),
+            headers=PP_REQ_HEADERS, data=json.dumps(data))
+        try:
+            return response.json()
+        except ValueError:
+            self.count(operation, 0, error=True)
+            raise
+
+    def verify_ipn_message(self, data):
+        verify_params = {'cmd': '_notify-validate'}
+        verify_params.update(data)
+
+        verify_result = self.request('notify-validate', 'GET', self.cmd_url,
+            params=verify_params).text
+        logger.info(verify_result)
+        return verify_result == 'VERIFIED'
+
+
+client = PaypalClient()
 
-    verify_result = requests.get(PP_CMD_URL, params=verify_params).text
-    logger.info(verify_result)
-    return verify_result == 'VERIFIED'
+
+def verify_ipn_message(data):
+    return client.verify_ipn_message(data)
 
 
 def create_preapproval(pledge):
     site = Site.objects.get_current()
 
-    url = PP_API_URL + '/AdaptivePayments/Preapproval'
-
     data = {
         'returnUrl': 'http://%s%s' % (site,
-            app_reverse('zipfelchappe_pledge_thankyou', settings.ROOT_URLS)),
+            app_reverse('zipfelchappe_pledge_thankyou', ROOT_URLS)),
         'cancelUrl': 'http://%s%s' % (site,
-            app_reverse('zipfelchappe_pledge_cancel', settings.ROOT_URLS)),
+            app_reverse('zipfelchappe_pledge_cancel', ROOT_URLS)),
         'ipnNotificationUrl': 'http://%s%s' % (site,
             reverse('zipfelchappe_paypal_ipn')),
         'currencyCode': pledge.currency,
@@ -84,9 +156,7 @@ def create_preapproval(pledge):
 
     logger.debug('ipn url %s' % data['ipnNotificationUrl'])
 
-    response = requests.post(url, headers=PP_REQ_HEADERS, data=json.dumps(data))
-
-    return response
+    return client.call('Preapproval', data)
 
 
 def get_receiver_entry(receiver, amount):
@@ -97,16 +167,14 @@ def get_receiver_entry(receiver, amount):
     }
 
 
-def create_payment(preapproval):
+def get_payment_data(preapproval):
+    """ Returns the request data to collect a preapproved payment """
     site = Site.objects.get_current()
 
     pledge = preapproval.pledge
 
-    url = PP_API_URL + '/AdaptivePayments/Pay'
-
     receivers = []
 
-
     if not settings.PAYPAL['RECEIVERS']:
         # TODO: do this on Project save as well.
         raise ImproperlyConfigured(_('No paypal receivers defined!'))
@@ -120,9 +188,9 @@ def create_payment(preapproval):
     data = {
         'actionType': 'PAY',
         'returnUrl': 'http://%s%s' % (site,
-            app_reverse('zipfelchappe_pledge_thankyou', settings.ROOT_URLS)),
+            app_reverse('zipfelchappe_pledge_thankyou', ROOT_URLS)),
         'cancelUrl': 'http://%s%s' % (site,
-            app_reverse('zipfelchappe_pledge_cancel', settings.ROOT_URLS)),
+            app_reverse('zipfelchappe_pledge_cancel', ROOT_URLS)),
         'ipnNotificationUrl': 'http://%s%s' % (site,
             reverse('zipfelchappe_paypal_ipn')),
         'currencyCode': pledge.currency,
@@ -136,4 +204,13 @@ def create_payment(preapproval):
         "requestEnvelope": {"errorLanguage": "en_US"},
     }
 
-    return requests.post(url, headers=PP_REQ_HEADERS, data=json.dumps(data))
+    return data
+
+
+def post_payment(data):
+    """ Sends a payment request, does not touch the database """
+    return client.call('Pay', data)
+
+
+def create_payment(preapproval):
+    return post_payment(get_payment_data(preapproval))
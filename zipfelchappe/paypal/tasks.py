@@ -1,9 +1,18 @@
 import json
+import logging
+from multiprocessing.pool import ThreadPool
 
-from zipfelchappe.models import Project, Pledge
+import requests
 
+from zipfelchappe.models import Project, Pledge, NotificationRejected
+from zipfelchappe.utils import RateLimiter
+
+from . import app_settings as settings
 from .models import Preapproval, Payment
-from .paypal_api import create_payment
+from .paypal_api import client, create_payment, get_payment_data, post_payment
+from .paypal_api import verify_ipn_message
+
+logger = logging.getLogger('zipfelchappe.paypal.tasks')
 
 
 class PaypalException(Exception):
@@ -24,8 +33,15 @@ def process_pledge(pledge):
         raise PaypalException('No preapproval for this pledge found')
 
     # All seems ok, try to execute paypal payment
-    pp_payment = create_payment(preapproval)
-    pp_data = pp_payment.json()
+    try:
+        pp_data = create_payment(preapproval)
+    except (requests.RequestException, ValueError) as e:
+        raise PaypalException('Payment request failed: %s' % e)
+    return apply_payment(pledge, preapproval, pp_data)
+
+
+def apply_payment(pledge, preapproval, pp_data):
+    """ Stores the answer of paypal to a payment request """
 
     Payment.objects.create(
         key=pp_data.get('payKey', 'ERROR_%s' % preapproval.key[:14]),
@@ -37,38 +53,196 @@ def process_pledge(pledge):
     if pp_data and 'error' in pp_data:
         # Mark pledge as FAILED after 3 retries
         if preapproval.payments.count() >= 3:
-            pledge.status = Pledge.FAILED
-            pledge.save()
+            pledge.update_status(Pledge.FAILED)
         for error in pp_data['error']:
             raise PaypalException(error['message'])
-    
+
     return pp_data
-    
 
-def process_payments():
+
+def request_payments(payment_requests, workers, rate_limit=None):
+    """
+    Sends (pledge, data) payment requests to paypal from a pool of worker
+    threads and yields (pledge, pp_data, error) in the order they finish.
+    The workers only do http, the database is only used by the caller.
+    """
+    limiter = RateLimiter(rate_limit)
+
+    def send(request):
+        pledge, data = request
+        limiter.wait()
+        try:
+            return pledge, post_payment(data), None
+        except Exception as e:
+            return pledge, None, e
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(send, payment_requests):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def process_payments(workers=1):
     """
     Collects the paypal payments for all successfully financed projects
-    that end within the next 24 hours.
+    that end within the next 24 hours. With more than one worker, the
+    payment requests are sent concurrently.
     """
 
-    billable_projects = Project.objects.billable()
+    billable_projects = Project.objects.billable(exclude_processed=True)
 
     # Pledges that are ready to be payed
-    processing_pledges = Pledge.objects.filter(
+    processing_pledges = list(Pledge.objects.filter(
         project__in=billable_projects,
         provider='paypal',
         status=Pledge.AUTHORIZED,
         paypal_preapproval__status='ACTIVE',
         paypal_preapproval__approved=True,
-    )
+    ).select_related('project', 'paypal_preapproval'))
+
+    if workers > 1:
+        collect_concurrently(processing_pledges, workers)
+    else:
+        collect_serially(processing_pledges)
+
+    return len(processing_pledges)
+
 
-    for pledge in processing_pledges:
+def collect_serially(pledges):
+    """ Collects the payments one after another. Pledges that could not be
+        sent are left alone and retried on the next run. """
+    results = {'requested': 0, 'failed': 0, 'errors': 0}
+    for pledge in pledges:
         try:
-            process_pledge(pledge)
-        except PaypalException as e:
-            pledge.status = pledge.FAILED
-            pledge.save()
-            # TODO: use logger
-            print e.message
-
-    return processing_pledges.count()
+            pp_data, error = create_payment(pledge.paypal_preapproval), None
+        except (requests.RequestException, ValueError) as e:
+            pp_data, error = None, e
+        store_result(pledge, pp_data, error, results)
+
+    log_results(results)
+    return results
+
+
+def collect_concurrently(pledges, workers):
+    """ Like collect_serially, but the payment requests are sent from a
+        pool of workers """
+    payment_requests = [
+        (pledge, get_payment_data(pledge.paypal_preapproval))
+        for pledge in pledges]
+
+    results = {'requested': 0, 'failed': 0, 'errors': 0}
+    for pledge, pp_data, error in request_payments(
+            payment_requests, workers, settings.PAYPAL['RATE_LIMIT']):
+        store_result(pledge, pp_data, error, results)
+
+    log_results(results)
+    return results
+
+
+def store_result(pledge, pp_data, error, results):
+    """ Stores the answer to a payment request and counts it in results """
+    if error is not None:
+        results['errors'] += 1
+        logger.error('Payment request for pledge %s failed: %r' % (
+            pledge.pk, error))
+        return
+    try:
+        apply_payment(pledge, pledge.paypal_preapproval, pp_data)
+        results['requested'] += 1
+    except PaypalException as e:
+        pledge.update_status(Pledge.FAILED)
+        results['failed'] += 1
+        logger.warning('Payment for pledge %s failed: %s' % (pledge.pk, e))
+
+
+def log_results(results):
+    logger.info('Requested %(requested)d payments, %(failed)d failed, '
+        '%(errors)d errors' % results)
+    logger.info('Paypal api stats: %r' % client.stats)
+
+
+def verify_ipn(data):
+    """ Asks paypal whether a queued IPN message has been sent by paypal """
+    if not verify_ipn_message(data.copy()):
+        raise NotificationRejected('IPN not verified: %s' % json.dumps(
+            data, ensure_ascii=False, indent=2))
+
+
+def process_ipn(data):
+    """ Applies a queued IPN message that has been verified by verify_ipn """
+    data = data.copy()
+    data['as_json'] = json.dumps(data, ensure_ascii=False, indent=2)
+
+    if 'transaction_type' not in data:
+        logger.warning('NO TRANSACTION TYPE: %s' % data['as_json'])
+    elif data['transaction_type'] == 'Adaptive Payment PREAPPROVAL':
+        handle_preapproval_ipn(data)
+    elif data['transaction_type'] == 'Adaptive Payment PAY':
+        handle_payment_ipn(data)
+    else:
+        logger.warning('UNHANDLED IPN MESSAGE: %s' % data['as_json'])
+
+
+def handle_preapproval_ipn(data):
+    key = data['preapproval_key']
+
+    try:
+        p = Preapproval.objects.select_for_update().get(key=key)
+    except Preapproval.DoesNotExist:
+        raise NotificationRejected('Prepapproval with key %s not found' % key)
+
+    reported, current = (Preapproval.status_rank(data['status']),
+                         Preapproval.status_rank(p.status))
+    if reported < current or (reported == current and
+                              data['status'] != p.status):
+        logger.info('Ignored status %s of preapproval %s, it is %s already' % (
+            data['status'], key, p.status))
+        return
+
+    p.status = data['status']
+    p.approved = data['approved'] == 'true'
+    p.sender = data['sender_email']
+    p.data = data['as_json']
+    p.save()
+
+    if p.status == Preapproval.ACTIVE and p.approved:
+        p.pledge.update_status(Pledge.AUTHORIZED)
+    elif p.pledge.status == Pledge.AUTHORIZED:
+        # Canceled after it was active, the pledge cannot be collected
+        p.pledge.update_status(Pledge.FAILED)
+    else:
+        p.pledge.update_status(Pledge.UNAUTHORIZED)
+
+    logger.debug('Preapproval message handled successfully')
+
+
+def handle_payment_ipn(data):
+    key = data['pay_key']
+
+    try:
+        p = Payment.objects.select_for_update().get(key=key)
+    except Payment.DoesNotExist:
+        raise NotificationRejected('Payment with key %s not found' % key)
+
+    reported, current = (Payment.status_rank(data['status']),
+                         Payment.status_rank(p.status))
+    if reported < current or (reported == current and
+                              data['status'] != p.status):
+        logger.info('Ignored status %s of payment %s, it is %s already' % (
+            data['status'], key, p.status))
+        return
+
+    p.status = data['status']
+    p.data = data['as_json']
+
+    p.save()
+    if p.status == 'COMPLETED':
+        p.preapproval.pledge.update_status(Pledge.PAID)
+    logger.debug('Payment message handled succefully')
+
+
+# Called by zipfelchappe.ipn.apply_notification before the transaction
+process_ipn.verify = verify_ipn
@@ -2,43 +2,100 @@ from xml.etree import ElementTree
 
 import requests
 import logging
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
 from zipfelchappe.postfinance.app_settings import POSTFINANCE
 
 env = 'prod' if POSTFINANCE['LIVE'] else 'test'
 api_logger = logging.getLogger('zipfelchappe.postfinance.api')
 
+DIRECT_LINK_URL = 'https://e-payment.postfinance.ch/ncol/%s' % env
+
+
+class DirectLinkClient(object):
+    """
+    Sends all Direct Link requests over one session, so connections are kept
+    alive and reused by concurrent workers, up to pool_size connections.
+    Requests time out after ZIPFELCHAPPE_POSTFINANCE['TIMEOUT'] (connect,
+    read) seconds. Only failed connections are retried, as maintenance
+    requests are not idempotent.
+
+    Requests, errors and the total time spent are counted per endpoint in
+    stats.
+    """
+
+    def __init__(self, base_url=None, timeout=None, retries=None,
+                 pool_size=10):
+        self.base_url = base_url or DIRECT_LINK_URL
+        self.timeout = timeout or POSTFINANCE['TIMEOUT']
+
+        if retries is None:
+            retries = POSTFINANCE['RETRIES']
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, read=0, backoff_factor=0.5))
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, endpoint, duration, error=False):
+        with self._lock:
+            stats = self.stats.setdefault(endpoint,
+                {'requests': 0, 'errors': 0, 'time': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['time'] += duration
+
+    def call(self, endpoint, payid, **params):
+        """ Posts a request for payid to endpoint and returns the attributes
+            of the ncresponse element """
+        payload = {
+            'PSPID': POSTFINANCE['PSPID'],
+            'USERID': POSTFINANCE['USERID'],
+            'PSWD': POSTFINANCE['PSWD'],
+            'PAYID': payid,
+        }
+        payload.update(params)
+
+        start = time.time()
+        try:
+            response = self.session.post(
+                '%s/%s' % (self.base_url, endpoint), data=payload,
+                timeout=self.timeout)
+            response.raise_for_status()
+            # Parse the raw bytes, the xml declaration names the encoding
+            ncresponse = ElementTree.fromstring(response.content)
+        except (requests.RequestException, SyntaxError):
+            # ElementTree.ParseError is a SyntaxError
+            self.count(endpoint, time.time() - start, error=True)
+            raise
+        self.count(endpoint, time.time() - start)
+
+        api_logger.debug('{0} for PayID {1}\n{2}'.format(
+            endpoint, payid, response.content))
+        return ncresponse.attrib.copy()
+
+    def request_payment(self, payid):
+        """ request payment of payid and close transaction """
+        return self.call('maintenancedirect.asp', payid, OPERATION='SAS')
+
+    def update_payment(self, payid):
+        """ query the current status of payid """
+        return self.call('querydirect.asp', payid)
+
+
+client = DirectLinkClient()
+
 
 def request_payment(payid):
-    """ request payment of payid and close transaction """
-    url = 'https://e-payment.postfinance.ch/ncol/%s/maintenancedirect.asp' % env
-    payload = {
-        'PSPID': POSTFINANCE['PSPID'],
-        'USERID': POSTFINANCE['USERID'],
-        'PSWD': POSTFINANCE['PSWD'],
-        'PAYID': payid,
-        'OPERATION': 'SAS'
-    }
-
-    response = requests.post(url, data=payload)
-    api_logger.debug('Requesting payment for ID {0}\n{1}'.format(
-        payid, response.text
-    ))
-    ncresponse = ElementTree.fromstring(response.text)
-    return ncresponse.attrib.copy()
+    return client.request_payment(payid)
 
 
 def update_payment(payid):
-    url = 'https://e-payment.postfinance.ch/ncol/%s/querydirect.asp' % env
-    payload = {
-        'PSPID': POSTFINANCE['PSPID'],
-        'USERID': POSTFINANCE['USERID'],
-        'PSWD': POSTFINANCE['PSWD'],
-        'PAYID': payid,
-    }
-
-    response = requests.post(url, data=payload)
-    api_logger.debug('Updating payment for PayID {0}\n{1}'.format(
-        payid, response.text
-    ))
-    ncresponse = ElementTree.fromstring(response.text)
-    return ncresponse.attrib.copy()
+    return client.update_payment(payid)
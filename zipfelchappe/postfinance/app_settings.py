@@ -10,6 +10,9 @@ Needs the following settings to work correctly::
         'SHA1_OUT': 'yourotherhash',
         'USERID': 'direct link API user id',
         'PSWD': 'direct link API user password',
+        'CHUNK_SIZE': 100,  # pledges loaded at once when collecting
+        'TIMEOUT': (5, 30), # Seconds to connect and to wait for an answer
+        'RETRIES': 2,
     }
 """
 from django.conf import settings
@@ -21,7 +24,10 @@ POSTFINANCE = {
     'SHA1_IN': '',
     'SHA1_OUT': '',
     'USERID': '',
-    'PSWD': ''
+    'PSWD': '',
+    'CHUNK_SIZE': 100,
+    'TIMEOUT': (5, 30),
+    'RETRIES': 2,
 }
 
 POSTFINANCE.update(getattr(settings, 'ZIPFELCHAPPE_POSTFINANCE', {}))
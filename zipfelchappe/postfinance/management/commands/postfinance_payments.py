@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 
 from zipfelchappe.postfinance.tasks import process_payments
@@ -7,6 +9,14 @@ class Command(BaseCommand):
 
     help = 'Collect all postfinance payments for finished projects (cronjob)'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            help='Number of pledges loaded at once'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of requests sent to postfinance concurrently'),
+    )
+
     def handle(self, *args, **options):
-        payments_processed = process_payments()
+        payments_processed = process_payments(
+            chunk_size=options['chunk_size'], workers=options['workers'])
         print "Total payments processed: %d " % payments_processed
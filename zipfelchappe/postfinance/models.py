@@ -39,6 +39,24 @@ STATUS_DICT = {
     '99': 'Being processed',
 }
 
+# How far a payment has progressed for each status. Notifications can arrive
+# late or more than once, so a payment never goes back to a lower rank.
+# Unknown statuses have rank 0.
+STATUS_RANKS = {
+    '4': 1, '41': 1,
+    '51': 2, '52': 2, '55': 2, '59': 2,
+    '5': 3,
+    '91': 4, '92': 4, '99': 4,
+    '9': 5, '93': 5, '95': 5,
+    '6': 6, '61': 6, '62': 6, '63': 6, '64': 6,
+    '7': 6, '71': 6, '72': 6, '73': 6, '74': 6, '75': 6,
+    '8': 6, '81': 6, '82': 6, '83': 6, '84': 6, '85': 6, '94': 6,
+}
+
+
+def status_rank(status):
+    return STATUS_RANKS.get(status, 0)
+
 
 class Payment(models.Model):
 
@@ -1,8 +1,13 @@
 from __future__ import unicode_literals, absolute_import
 import logging
+from multiprocessing.pool import ThreadPool
 
-from zipfelchappe.models import Project, Pledge
-from .models import Payment, STATUS_DICT
+import requests
+
+from zipfelchappe.export import iterate_in_chunks
+from zipfelchappe.models import Project, Pledge, NotificationRejected
+from .app_settings import POSTFINANCE
+from .models import Payment, STATUS_DICT, status_rank
 from .api.direct_link_v1 import request_payment, update_payment
 
 logger = logging.getLogger('zipfelchappe.postfinance.ipn')
@@ -14,35 +19,40 @@ class PostfinanceException(Exception):
         super(PostfinanceException, self).__init__(message, *args, **kwargs)
 
     
-def process_pledge(pledge):
-    """ Collect postfinance payment for exactly one pledge """
+def get_payment(pledge):
     try:
-        payment = pledge.postfinance_payment
+        return pledge.postfinance_payment
     except Payment.DoesNotExist:
         raise PostfinanceException('Payment for pledge %s not found' % pledge.pk)
 
+
+def send_request(payment):
+    """ Sends the direct link request that the payment status calls for """
     if payment.STATUS == '91':
         # payment is in processing state, check status
-        result = update_payment(payment.PAYID)
+        return update_payment(payment.PAYID)
+    elif payment.STATUS == '5':
+        # Payment is authorized, request transaction
+        return request_payment(payment.PAYID)
+    else:
+        raise PostfinanceException('Payment is not authorized')
+
+
+def apply_result(pledge, payment, result):
+    """ Stores the answer of postfinance to a direct link request """
+    if payment.STATUS == '91':
         if result['STATUS'] == '9':
             payment.STATUS = result['STATUS']
             payment.save()
 
-            payment.pledge.status = Pledge.PAID
-            payment.pledge.save()
+            pledge.update_status(Pledge.PAID)
             logger.info('Pledge {0} has been paid.'.format(pledge.pk))
             return result
         logger.debug('New status for pledge {0}: {1}:{2}'.format(
             pledge.pk, payment.STATUS, STATUS_DICT[payment.STATUS]
         ))
 
-    elif payment.STATUS == '5':
-        # Payment is authorized, request transaction
-        try:
-            result = request_payment(payment.PAYID)
-        except Exception as e:
-            raise PostfinanceException(e.message)
-
+    else:
         if 'STATUS' not in result or result['STATUS'] == '0':
             raise PostfinanceException('Incomplete or invalid status')
         else:
@@ -51,34 +61,152 @@ def process_pledge(pledge):
             logger.info('Pledge {0} has been paid. Status:{1}'.format(pledge.pk, result['STATUS']))
 
         return result
-    else:
-        raise PostfinanceException('Payment is not authorized')
 
 
-def process_payments():
+def process_pledge(pledge):
+    """ Collect postfinance payment for exactly one pledge """
+    payment = get_payment(pledge)
+
+    try:
+        result = send_request(payment)
+    except (requests.RequestException, SyntaxError) as e:
+        raise PostfinanceException('Direct link request failed: %s' % e)
+
+    return apply_result(pledge, payment, result)
+
+
+def send_requests(pledges, pool):
+    """
+    Sends the direct link requests of pledges from a pool of worker threads
+    and yields (pledge, payment, result, error) in the order they finish.
+    The workers only do http, the database is only used by the caller.
+    """
+    def send(pledge):
+        try:
+            payment = get_payment(pledge)
+            return pledge, payment, send_request(payment), None
+        except Exception as e:
+            return pledge, None, None, e
+
+    return pool.imap_unordered(send, pledges)
+
+
+def process_payments(chunk_size=None, workers=1):
     """
     Collect postfinance payments for all successfully financed projects
     that end within the next 24 hours. Postfinance Direct Link Option is
-    required for this to work.
+    required for this to work. Pledges are loaded in chunks of chunk_size
+    together with their payment and project. With more than one worker, the
+    requests of a chunk are sent concurrently.
     """
+    chunk_size = chunk_size or POSTFINANCE['CHUNK_SIZE']
 
-    billable_projects = Project.objects.billable()
+    billable_projects = Project.objects.billable(exclude_processed=True)
 
     pledges = Pledge.objects.filter(
         project__in=billable_projects,
         provider='postfinance',
         status=Pledge.AUTHORIZED
-    )
-    logger.info('Collecting payments for {0} pledges in {1} projects.'.format(
-        len(pledges), len(billable_projects)
-    ))
+    ).select_related('postfinance_payment', 'project')
 
+    results = {'processed': 0, 'failed': 0, 'errors': 0}
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        for chunk in iterate_in_chunks(pledges, chunk_size):
+            if pool is None:
+                collect_serially(chunk, results)
+            else:
+                collect_concurrently(chunk, pool, results)
+            logger.info('Collected {processed} payments so far, {failed} '
+                'failed, {errors} errors.'.format(**results))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    logger.info('Collected {processed} payments, {failed} failed, '
+        '{errors} errors.'.format(**results))
+    return sum(results.values())
+
+
+def collect_serially(pledges, results):
+    """ Collects the payments one after another. Pledges whose request could
+        not be sent are left alone and retried on the next run. """
     for pledge in pledges:
         try:
-            process_pledge(pledge)
-        except PostfinanceException as e:
-            print e.message
+            payment = get_payment(pledge)
+            result, error = send_request(payment), None
+        except (PostfinanceException, requests.RequestException,
+                SyntaxError) as e:
+            # ElementTree.ParseError is a SyntaxError
+            payment, result, error = None, None, e
+        store_result(pledge, payment, result, error, results)
+
+
+def collect_concurrently(pledges, pool, results):
+    """ Like collect_serially, but the requests are sent from a pool of
+        workers """
+    for pledge, payment, result, error in send_requests(pledges, pool):
+        store_result(pledge, payment, result, error, results)
+
+
+def store_result(pledge, payment, result, error, results):
+    """ Stores the answer to a direct link request and counts it in
+        results """
+    if isinstance(error, PostfinanceException):
+        results['failed'] += 1
+        return
+    if error is not None:
+        results['errors'] += 1
+        logger.error('Direct link request for pledge {0} failed: '
+            '{1!r}'.format(pledge.pk, error))
+        return
+    try:
+        apply_result(pledge, payment, result)
+        results['processed'] += 1
+    except PostfinanceException:
+        results['failed'] += 1
+
 
-    return pledges.count()
+def process_ipn(data):
+    """ Applies a queued IPN message, its signature is checked on receipt """
+    orderID = data['orderID']
 
+    try:
+        # FIXME: Projekte, die ein '-' im Slug haben, schlagen hier fehl.
+        project_slug, pledge_id = orderID.split('-')
+    except ValueError:
+        raise NotificationRejected('Malformed order ID %s' % orderID)
 
+    try:
+        pledge = Pledge.objects.get(pk=pledge_id)
+    except Pledge.DoesNotExist:
+        raise NotificationRejected('Pledge %s does not exist' % pledge_id)
+
+    # save status to database
+    p, created = Payment.objects.select_for_update().get_or_create(
+        order_id=orderID, pledge=pledge)
+    reported, current = status_rank(data['STATUS']), status_rank(p.STATUS)
+    if not created and (reported < current or (reported == current and
+                                               data['STATUS'] != p.STATUS)):
+        # Late, the payment has progressed since
+        logger.info('IPN: Ignored status %s of %s, payment is at %s' % (
+            data['STATUS'], orderID, p.STATUS))
+        return
+
+    p.amount = data['amount']
+    p.currency = data['currency']
+    p.STATUS = data['STATUS']
+    p.PAYID = data['PAYID']
+    p.PM = data['PM']
+    p.ACCEPTANCE = data['ACCEPTANCE']
+    p.CARDNO = data['CARDNO']
+    p.BRAND = data['BRAND']
+    p.save()
+
+    logger.info('IPN: Status = %s' % p.STATUS)
+    if p.STATUS == '5':
+        pledge.update_status(Pledge.AUTHORIZED)
+    if p.STATUS == '9':
+        pledge.update_status(Pledge.PAID)
+    logger.info('IPN: Successfully processed IPN request for %s' % orderID)
@@ -21,12 +21,11 @@ from django.shortcuts import render
 
 from feincms.content.application.models import app_reverse
 
+from zipfelchappe.ipn import queue_notification
 from zipfelchappe.views import requires_pledge
-from zipfelchappe.models import Pledge
 
 from ..app_settings import ROOT_URLS
 from .app_settings import POSTFINANCE
-from .models import Payment
 
 logger = logging.getLogger('zipfelchappe.postfinance.ipn')
 api_logger = logging.getLogger('zipfelchappe.postfinance.api')
@@ -139,41 +138,9 @@ def ipn(request):
             logger.error('IPN: Invalid hash in %s' % parameters_repr)
             return HttpResponseForbidden('Hash did not validate')
 
-        try:
-            # FIXME: Projekte, die ein '-' im Slug haben, schlagen hier fehl.
-            project_slug, pledge_id = orderID.split('-')
-        except ValueError:
-            logger.error('IPN: Error getting pledge id from %s' % orderID)
-            return HttpResponseForbidden('Malformed order ID')
-
-        try:
-            pledge = Pledge.objects.get(pk=pledge_id)
-        except Pledge.DoesNotExist:
-            logger.error('IPN: Pledge %s does not exist' % pledge_id)
-            return HttpResponseForbidden('Pledge %s does not exist' % pledge_id)
-
-
-        # save status to database
-        p, created = Payment.objects.get_or_create(
-            order_id=orderID, pledge=pledge)
-        p.amount = amount
-        p.currency = currency
-        p.STATUS = STATUS
-        p.PAYID = PAYID
-        p.PM = PM
-        p.ACCEPTANCE = ACCEPTANCE
-        p.CARDNO = CARDNO
-        p.BRAND = BRAND
-        p.save()
-
-        logger.info('IPN: Status = %s' % STATUS)
-        if STATUS == '5':
-            pledge.status = Pledge.AUTHORIZED
-        if STATUS == '9':
-            pledge.status = Pledge.PAID
-
-        pledge.save()
-        logger.info('IPN: Successfully processed IPN request for %s' % orderID)
+        # Applied later by zipfelchappe.postfinance.tasks.process_ipn
+        queue_notification('postfinance', orderID, STATUS, request.POST)
+        logger.info('IPN: Queued IPN request for %s' % orderID)
         return HttpResponse('OK')
     except Exception, e:
         logger.error('IPN: Processing failure %s' % unicode(e))
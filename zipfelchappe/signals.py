@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+from .utils import on_commit
+
+# Sent with the project_id after the funding counters or the claimed rewards
+# of a project changed
+funding_changed = Signal(providing_args=['project_id'])
+
+
+def send_funding_changed(sender, project_id):
+    """ Sends funding_changed once the changed counters have been committed,
+        so that receivers never read the old ones """
+    on_commit(lambda: funding_changed.send(sender=sender,
+                                           project_id=project_id))
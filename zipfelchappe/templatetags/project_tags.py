@@ -2,6 +2,8 @@ from __future__ import unicode_literals, absolute_import
 from django.utils import timezone
 from django import template
 
+from ..cache import fragment_key, project_namespace
+
 register = template.Library()
 
 
@@ -41,3 +43,10 @@ def remaining(project, value):
             return (td.seconds//60) % 60
     else:
         return 0
+
+
+@register.filter
+def teaser_cache_key(project):
+    """ Key of the cached parts of a project teaser. The remaining time and
+        the status are rendered on every request. """
+    return fragment_key(project_namespace(project.pk), project.is_over)
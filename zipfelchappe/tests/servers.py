@@ -0,0 +1,127 @@
+"""
+Local stand-ins for the payment provider APIs, so the code talking to them
+can be tested without network access.
+"""
+import json
+import threading
+from urlparse import parse_qs
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    """
+    Runs a http server with the given handler on a free local port while
+    used as a context manager. Received requests are stored in requests.
+    """
+
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        self.server.requests.append((self.command, self.path, body))
+        return body
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PaypalHandler(StandInHandler):
+    """
+    Mimics the Adaptive Payments Pay endpoint and IPN verification.
+    Preapproval keys starting with FAIL are answered with an error, IPN
+    messages with a verify_sign of INVALID are not verified.
+    """
+
+    def do_GET(self):
+        self.read_body()
+        body = 'INVALID' if 'verify_sign=INVALID' in self.path else 'VERIFIED'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = json.loads(self.read_body())
+
+        if self.path != '/AdaptivePayments/Pay':
+            self.send_json({'error': [{'message': 'Not found'}]}, 404)
+        elif data['preapprovalKey'].startswith('FAIL'):
+            self.send_json({
+                'responseEnvelope': {'ack': 'Failure'},
+                'error': [{'errorId': '579024',
+                           'message': 'The preapproval key has expired'}],
+            })
+        else:
+            self.send_json({
+                'responseEnvelope': {'ack': 'Success'},
+                'payKey': 'AP-%s' % data['preapprovalKey'],
+                'paymentExecStatus': 'COMPLETED',
+            })
+
+
+class PostfinanceHandler(StandInHandler):
+    """
+    Mimics the Direct Link maintenance and query endpoints. Captures are
+    answered with status 91 (processing) and queries with 9 (paid), PAYIDs
+    starting with FAIL are answered with status 0 (invalid).
+    """
+
+    def do_POST(self):
+        data = dict((k, v[0]) for k, v in parse_qs(self.read_body()).items())
+        payid = data['PAYID']
+
+        if self.path == '/maintenancedirect.asp':
+            status = '91'
+        elif self.path == '/querydirect.asp':
+            status = '9'
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if payid.startswith('FAIL'):
+            status = '0'
+
+        body = ('<?xml version="1.0"?>\n<ncresponse orderID="" '
+            'PAYID="%s" NCSTATUS="0" NCERROR="0" STATUS="%s"/>' % (
+                payid, status))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -4,6 +4,7 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from django.utils import timezone
 from feincms.module.page.models import Page
 from feincms.content.application.models import ApplicationContent
@@ -73,3 +74,95 @@ class AdminViewsTest(TestCase):
         self.assertEquals(200, response.status_code)
         self.assertContains(response, _('Collecting'))
         self.assertContains(response, self.project1.title)
+
+    def test_export_pledges(self):
+        from django.contrib import admin
+        from ..export import CSVExporter
+
+        for i in range(3):
+            PledgeFactory.create(project=self.project1, amount=10 + i)
+        Pledge.objects.order_by('pk')[0].set_extra_data({'shirt': 'XL'})
+
+        self.client.login(username=self.admin.username, password='test')
+        response = self.client.post(
+            reverse('admin:zipfelchappe_pledge_changelist'), {
+                'action': 'export_as_csv',
+                '_selected_action': Pledge.objects.values_list(
+                    'pk', flat=True),
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith(b'Username,Email'))
+        self.assertTrue(lines[1].endswith(b',XL'))
+
+        # Pledges, profiles and extra values of a chunk are loaded with one
+        # query each
+        exporter = CSVExporter(admin.site._registry[Pledge],
+            Pledge.objects.all())
+        with self.assertNumQueries(7):
+            rows = list(exporter.rows(chunk_size=2))
+        self.assertEqual(len(rows), 3)
+
+    def test_export_job(self):
+        import gzip
+        import shutil
+        import tempfile
+        from .. import export
+        from ..models import ExportJob
+
+        pledges = [PledgeFactory.create(project=self.project1, amount=10 + i)
+            for i in range(3)]
+
+        self.client.login(username=self.admin.username, password='test')
+        self.client.post(reverse('admin:zipfelchappe_pledge_changelist'), {
+            'action': 'export_as_csv_in_background',
+            '_selected_action': [p.pk for p in pledges],
+        })
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, ExportJob.QUEUED)
+        self.assertEqual(job.get_object_ids(), [p.pk for p in pledges])
+        self.assertEqual(job.get_queryset().count(), 3)
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        # Let the worker die after the first chunk
+        chunks = export.CSVExporter.chunks
+
+        def crash(self, *args, **kwargs):
+            for chunk in chunks(self, *args, **kwargs):
+                yield chunk
+                raise RuntimeError('Worker died')
+
+        with override_settings(MEDIA_ROOT=media_root):
+            export.CSVExporter.chunks = crash
+            try:
+                self.assertRaises(RuntimeError, export.run_export_job, job, 2)
+            finally:
+                export.CSVExporter.chunks = chunks
+
+            job = ExportJob.objects.get()
+            self.assertEqual(job.status, ExportJob.RUNNING)
+            self.assertEqual((job.rows, job.checkpoint), (2, pledges[1].pk))
+
+            # Half written chunk
+            path = '%s/%s' % (media_root, job.file.name)
+            with open(path, 'ab') as output:
+                output.write(b'garbage')
+
+            export.run_export_job(job, 2)
+            job = ExportJob.objects.get()
+            self.assertEqual((job.status, job.rows), (ExportJob.DONE, 3))
+
+            lines = gzip.open(path).read().splitlines()
+            self.assertEqual(len(lines), 4)
+            self.assertTrue(lines[0].startswith(b'Username,Email'))
+
+            url = reverse('admin:zipfelchappe_exportjob_download',
+                args=(job.pk,))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content),
+                open(path, 'rb').read())
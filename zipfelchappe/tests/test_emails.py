@@ -0,0 +1,229 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+from smtplib import SMTPRecipientsRefused
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import translation
+from django.utils.timezone import now
+
+from feincms.module.page.models import Page
+from feincms.content.application.models import ApplicationContent
+
+from ..emails import queue_mail, send_queued_mails
+from ..emails import compiled_templates, render_pledge_completed_message
+from ..emails import send_update_mails
+from ..models import MailTemplate, Pledge, QueuedMail, Update
+from ..translations.models import ProjectTranslation, MailTemplateTranslation
+from .. import app_settings
+
+from .factories import ProjectFactory, PledgeFactory, BackerFactory
+from .factories import UserFactory
+
+
+class RefusingBackend(EmailBackend):
+    """ Refuses every mail to an example.org address """
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0].endswith('@example.org'):
+                raise SMTPRecipientsRefused(message.to)
+        return super(RefusingBackend, self).send_messages(messages)
+
+
+class OverlappingBackend(EmailBackend):
+    """ Starts another run of the mail queue while the first mail is sent """
+
+    overlapping = []
+
+    def send_messages(self, messages):
+        if not self.overlapping:
+            # Marked first, as the other run opens a connection as well
+            self.overlapping.append(None)
+            self.overlapping[0] = send_queued_mails()
+        return super(OverlappingBackend, self).send_messages(messages)
+
+
+@override_settings(
+    EMAIL_BACKEND='zipfelchappe.tests.test_emails.RefusingBackend')
+class MailQueueTest(TestCase):
+
+    def test_send_batch(self):
+        for i in range(3):
+            queue_mail('Hello', 'Message', 'backer%d@example.com' % i)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_queued_mails(), (3, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(
+            QueuedMail.objects.filter(status=QueuedMail.SENT).count(), 3)
+
+        # Nothing left to send
+        self.assertEqual(send_queued_mails(), (0, 0))
+
+    @override_settings(
+        EMAIL_BACKEND='zipfelchappe.tests.test_emails.OverlappingBackend')
+    def test_overlapping_runs(self):
+        for i in range(3):
+            queue_mail('Hello', 'Message', 'backer%d@example.com' % i)
+
+        del OverlappingBackend.overlapping[:]
+        self.assertEqual(send_queued_mails(), (3, 0))
+        # The mails were claimed by the first run
+        self.assertEqual(OverlappingBackend.overlapping, [(0, 0)])
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_claim_timeout(self):
+        claimed = queue_mail('Hello', 'Message', 'backer@example.com')
+        QueuedMail.objects.filter(pk=claimed.pk).update(
+            status=QueuedMail.SENDING, next_attempt=now() + timedelta(
+                seconds=app_settings.MAIL_CLAIM_TIMEOUT))
+        self.assertEqual(send_queued_mails(), (0, 0))
+
+        # The run that claimed it died
+        QueuedMail.objects.filter(pk=claimed.pk).update(
+            next_attempt=now() - timedelta(seconds=1))
+        self.assertEqual(send_queued_mails(), (1, 0))
+        self.assertEqual(QueuedMail.objects.get().status, QueuedMail.SENT)
+
+    def test_retry_and_give_up(self):
+        queue_mail('Hello', 'Message', 'backer@example.org')
+        good = queue_mail('Hello', 'Message', 'backer@example.com')
+
+        self.assertEqual(send_queued_mails(), (1, 1))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [good.recipient])
+
+        failed = QueuedMail.objects.get(recipient='backer@example.org')
+        self.assertEqual(failed.status, QueuedMail.QUEUED)
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn('SMTPRecipientsRefused', failed.last_error)
+        self.assertTrue(failed.next_attempt > now())
+
+        # Not due yet
+        self.assertEqual(send_queued_mails(), (0, 0))
+
+        for attempt in range(2, app_settings.MAIL_MAX_ATTEMPTS + 1):
+            QueuedMail.objects.filter(pk=failed.pk).update(
+                next_attempt=now() - timedelta(seconds=1))
+            self.assertEqual(send_queued_mails(), (0, 1))
+
+        failed = QueuedMail.objects.get(pk=failed.pk)
+        self.assertEqual(failed.status, QueuedMail.FAILED)
+        self.assertEqual(failed.attempts, app_settings.MAIL_MAX_ATTEMPTS)
+
+        # Dead mails are not retried
+        QueuedMail.objects.filter(pk=failed.pk).update(
+            next_attempt=now() - timedelta(seconds=1))
+        self.assertEqual(send_queued_mails(), (0, 0))
+
+
+class MailTemplateCacheTest(TestCase):
+
+    def setUp(self):
+        compiled_templates.clear()
+        self.pledge = PledgeFactory.create(project=ProjectFactory.create(),
+            amount=10)
+        self.mail_template = MailTemplate.objects.create(
+            project=self.pledge.project,
+            subject='Thanks {{ pledge.backer.first_name }}',
+            template='You gave {{ pledge.amount }}',
+        )
+
+    def test_templates_compiled_once(self):
+        subject, message = render_pledge_completed_message(self.pledge)
+        self.assertEqual(subject,
+            'Thanks %s' % self.pledge.backer.first_name)
+        self.assertEqual(len(compiled_templates), 1)
+
+        # Only the mail template is looked up
+        with self.assertNumQueries(1):
+            render_pledge_completed_message(self.pledge)
+        self.assertEqual(len(compiled_templates), 1)
+
+    def test_save_invalidates(self):
+        render_pledge_completed_message(self.pledge)
+        self.mail_template.subject = 'Thank you'
+        self.mail_template.save()
+        self.assertEqual(len(compiled_templates), 0)
+
+        subject, message = render_pledge_completed_message(self.pledge)
+        self.assertEqual(subject, 'Thank you')
+
+    def test_translation_save_invalidates(self):
+        with translation.override('de'):
+            render_pledge_completed_message(self.pledge)
+            project_translation = ProjectTranslation.objects.create(
+                translation_of=self.pledge.project, lang='de', title='Titel')
+            MailTemplateTranslation.objects.create(
+                translation=project_translation,
+                translation_of=self.mail_template,
+                subject='Danke', template='Danke')
+            self.assertEqual(len(compiled_templates), 0)
+
+            subject, message = render_pledge_completed_message(self.pledge)
+            self.assertEqual(subject, 'Danke')
+
+
+class UpdateMailTest(TestCase):
+
+    def setUp(self):
+        # The mails link to the project page
+        page = Page.objects.create(title='Projects', slug='projects')
+        page.content_type_for(ApplicationContent).objects.create(
+            parent=page, urlconf_path=app_settings.ROOT_URLS)
+
+        self.project = ProjectFactory.create()
+        self.backers = []
+        for i in range(3):
+            backer = BackerFactory.create(_email='backer%d@example.com' % i)
+            PledgeFactory.create(project=self.project, backer=backer,
+                amount=10)
+            self.backers.append(backer)
+        # Pledged twice, mailed once
+        PledgeFactory.create(project=self.project, backer=self.backers[0],
+            amount=5)
+        # Same address in a later chunk, mailed once. The address of the
+        # user is used before the one of the backer.
+        self.duplicate = BackerFactory.create(_email='old@example.com',
+            user=UserFactory.create(email='backer0@example.com'))
+        PledgeFactory.create(project=self.project, backer=self.duplicate,
+            amount=5)
+        # Not authorized, not mailed
+        PledgeFactory.create(project=self.project, amount=5,
+            status=Pledge.UNAUTHORIZED,
+            backer=BackerFactory.create(_email='unauthorized@example.com'))
+
+    def test_published_update_scheduled(self):
+        update = Update.objects.create(project=self.project, title='News')
+        self.assertEqual(update.mails_checkpoint, None)
+
+        update.status = Update.STATUS_PUBLISHED
+        update.save()
+        self.assertEqual(update.mails_checkpoint, 0)
+
+    def test_send_update_mails(self):
+        update = Update.objects.create(project=self.project, title='News',
+            status=Update.STATUS_PUBLISHED)
+
+        self.assertEqual(send_update_mails(update, chunk_size=2), 3)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+            ['backer%d@example.com' % i for i in range(3)])
+        # Rendered once for all backers
+        self.assertEqual(len(set(m.body for m in mail.outbox)), 1)
+
+        update = Update.objects.get(pk=update.pk)
+        self.assertTrue(update.mails_sent)
+        self.assertEqual(update.mails_checkpoint, self.duplicate.pk)
+
+    def test_resume_update_mails(self):
+        update = Update.objects.create(project=self.project, title='News',
+            status=Update.STATUS_PUBLISHED)
+        update.mails_checkpoint = self.backers[0].pk
+
+        self.assertEqual(send_update_mails(update), 2)
+        self.assertEqual([m.to[0] for m in mail.outbox],
+            ['backer1@example.com', 'backer2@example.com'])
@@ -0,0 +1,117 @@
+from __future__ import unicode_literals, absolute_import
+import threading
+
+from django.test import TestCase, TransactionTestCase
+
+from .. import events
+from ..events import CacheBroker, DatabaseBroker, LocalBroker, event_stream
+from ..models import Pledge
+from ..utils import atomic, run_commit_callbacks
+
+from .factories import ProjectFactory, PledgeFactory
+
+
+class EventStreamTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+        self.broker = LocalBroker()
+        events._broker = self.broker
+
+    def tearDown(self):
+        run_commit_callbacks(committed=False)
+        events._broker = None
+
+    def test_changes_are_coalesced(self):
+        data = iter(['first', 'second'])
+        stream = event_stream(self.broker, self.project.pk, lambda: next(data),
+                              interval=0.2, timeout=1)
+
+        self.assertEqual(next(stream), 'retry: 200\n\n')
+        # The current status is sent right away
+        self.assertEqual(next(stream), 'event: funding\ndata: first\n\n')
+
+        # Pledges change the funding while the interval passes
+        threading.Timer(0.05, lambda: [
+            self.broker.publish(self.project.pk) for i in range(3)]).start()
+        self.assertEqual(next(stream), 'event: funding\ndata: second\n\n')
+
+        # Nothing changes until the stream ends
+        self.assertEqual(list(stream), [': keepalive\n\n'])
+
+    def test_pledges_are_published(self):
+        token = self.broker.wait(self.project.pk, None, 0)
+        PledgeFactory.create(project=self.project, amount=10,
+            status=Pledge.AUTHORIZED)
+        # Not before the test transaction would be committed
+        self.assertEqual(self.broker.wait(self.project.pk, token, 0), token)
+        run_commit_callbacks()
+        self.assertNotEqual(self.broker.wait(self.project.pk, token, 0), token)
+
+    def test_event_view(self):
+        url = '/events/%s/' % self.project.slug
+
+        r = self.client.get(url)
+        self.assertEqual(r['Content-Type'], 'text/event-stream')
+        content = iter(r.streaming_content)
+        next(content)
+        self.assertIn('"backers": 0', next(content))
+
+        # Disabled
+        events._broker, broker_setting = None, events.EVENT_BROKER
+        events.EVENT_BROKER = None
+        try:
+            self.assertEqual(self.client.get(url).status_code, 404)
+        finally:
+            events.EVENT_BROKER = broker_setting
+
+    def test_cache_broker(self):
+        broker = CacheBroker(poll_interval=0.01)
+        with self.assertNumQueries(0):
+            token = broker.wait(self.project.pk, None, 0)
+            self.assertEqual(broker.wait(self.project.pk, token, 0.05), token)
+
+        PledgeFactory.create(project=self.project, amount=10,
+            status=Pledge.AUTHORIZED)
+        run_commit_callbacks()
+        self.assertNotEqual(broker.wait(self.project.pk, token, 0), token)
+
+    def test_database_broker(self):
+        broker = DatabaseBroker(poll_interval=0.01)
+        token = broker.wait(self.project.pk, None, 0)
+        self.assertEqual(token, self.project.modified)
+        self.assertEqual(broker.wait(self.project.pk, token, 0.05), token)
+
+        pledge = PledgeFactory.create(project=self.project, amount=10)
+        pledge.update_status(Pledge.AUTHORIZED)
+        self.assertNotEqual(broker.wait(self.project.pk, token, 0), token)
+
+
+class PublishOnCommitTest(TransactionTestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+        self.broker = LocalBroker()
+        events._broker = self.broker
+
+    def tearDown(self):
+        events._broker = None
+
+    def test_published_after_commit(self):
+        token = self.broker.wait(self.project.pk, None, 0)
+        with atomic():
+            with atomic():
+                PledgeFactory.create(project=self.project, amount=10,
+                    status=Pledge.AUTHORIZED)
+            self.assertEqual(self.broker.wait(self.project.pk, token, 0),
+                             token)
+        self.assertNotEqual(self.broker.wait(self.project.pk, token, 0), token)
+
+    def test_not_published_after_rollback(self):
+        token = self.broker.wait(self.project.pk, None, 0)
+        with self.assertRaises(ValueError):
+            with atomic():
+                PledgeFactory.create(project=self.project, amount=10,
+                    status=Pledge.AUTHORIZED)
+                raise ValueError
+        self.assertEqual(self.broker.wait(self.project.pk, token, 0), token)
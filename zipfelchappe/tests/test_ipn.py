@@ -0,0 +1,219 @@
+from __future__ import absolute_import, unicode_literals
+
+from hashlib import sha1
+
+from django.test import TestCase
+from django.test.client import Client
+
+from ..ipn import process_notifications
+from ..models import Pledge, PaymentNotification, ProcessedNotification
+from ..models import Project
+from ..paypal import paypal_api
+from ..paypal.models import Payment as PaypalPayment, Preapproval
+from ..postfinance.app_settings import POSTFINANCE
+from ..postfinance.models import Payment
+
+from .factories import ProjectFactory, PledgeFactory
+from .servers import StandInServer, PaypalHandler
+
+
+class NotificationTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create(slug='tree')
+        self.pledge = PledgeFactory.create(project=self.project, amount=20,
+            status=Pledge.UNAUTHORIZED)
+        self.client = Client()
+
+    def postfinance_ipn(self, status, order_id=None):
+        data = {
+            'orderID': order_id or 'tree-%s' % self.pledge.pk,
+            'amount': '20',
+            'currency': 'CHF',
+            'PM': 'CreditCard',
+            'ACCEPTANCE': 'test123',
+            'STATUS': status,
+            'CARDNO': 'XXXXXXXXXXXX1111',
+            'PAYID': '1234',
+            'NCERROR': '0',
+            'BRAND': 'VISA',
+        }
+        data['SHASIGN'] = sha1(''.join(data[k] for k in (
+            'orderID', 'currency', 'amount', 'PM', 'ACCEPTANCE', 'STATUS',
+            'CARDNO', 'PAYID', 'NCERROR', 'BRAND')) + POSTFINANCE['SHA1_OUT']
+        ).hexdigest()
+        return self.client.post('/postfinance/ipn/', data)
+
+    def test_postfinance_ipn_queued(self):
+        response = self.postfinance_ipn('5')
+        self.assertEqual(response.status_code, 200)
+
+        # Nothing applied yet
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.UNAUTHORIZED)
+        notification = PaymentNotification.objects.get()
+        self.assertEqual(notification.key, 'tree-%s' % self.pledge.pk)
+
+        self.assertEqual(process_notifications(),
+            {'processed': 1, 'duplicate': 0, 'rejected': 0, 'failed': 0})
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.AUTHORIZED)
+        self.assertEqual(self.pledge.postfinance_payment.STATUS, '5')
+
+    def test_duplicates_skipped(self):
+        self.postfinance_ipn('9')
+        self.postfinance_ipn('9')
+        self.assertEqual(process_notifications(),
+            {'processed': 1, 'duplicate': 1, 'rejected': 0, 'failed': 0})
+        self.assertEqual(ProcessedNotification.objects.count(), 1)
+
+    def test_paid_stays_paid(self):
+        # A late authorization must not move the pledge backwards
+        self.postfinance_ipn('9')
+        self.postfinance_ipn('5')
+        self.assertEqual(process_notifications()['processed'], 2)
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.PAID)
+        self.assertEqual(self.pledge.postfinance_payment.STATUS, '9')
+
+    def test_out_of_order_notifications(self):
+        self.postfinance_ipn('5')
+        self.postfinance_ipn('9')
+        self.postfinance_ipn('91')
+        # Replayed authorization
+        self.postfinance_ipn('5')
+        self.assertEqual(process_notifications()['processed'], 3)
+        self.assertEqual(Payment.objects.get().STATUS, '9')
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.PAID)
+
+    def test_paypal_payment_stays_completed(self):
+        self.pledge.update_status(Pledge.AUTHORIZED)
+        preapproval = Preapproval.objects.create(pledge=self.pledge,
+            key='PA-1', amount=20, status='ACTIVE', approved=True)
+        PaypalPayment.objects.create(key='AP-1', preapproval=preapproval,
+            status='CREATED')
+        data = {'transaction_type': 'Adaptive Payment PAY', 'pay_key': 'AP-1'}
+        self.client.post('/paypal/ipn/', dict(data, status='COMPLETED'))
+        self.client.post('/paypal/ipn/', dict(data, status='PENDING'))
+
+        cmd_url = paypal_api.client.cmd_url
+        try:
+            with StandInServer(PaypalHandler) as server:
+                paypal_api.client.cmd_url = server.url
+                self.assertEqual(process_notifications()['processed'], 2)
+        finally:
+            paypal_api.client.cmd_url = cmd_url
+
+        self.assertEqual(PaypalPayment.objects.get().status, 'COMPLETED')
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.PAID)
+
+    def test_postfinance_invalid_hash(self):
+        response = self.client.post('/postfinance/ipn/', {
+            'orderID': 'tree-1', 'amount': '20', 'currency': 'CHF',
+            'PM': '', 'ACCEPTANCE': '', 'STATUS': '9', 'CARDNO': '',
+            'PAYID': '', 'NCERROR': '', 'BRAND': '', 'SHASIGN': 'forged',
+        })
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(PaymentNotification.objects.count(), 0)
+
+    def test_rejected_notification(self):
+        self.postfinance_ipn('5', order_id='tree-999')
+        self.assertEqual(process_notifications(),
+            {'processed': 0, 'duplicate': 0, 'rejected': 1, 'failed': 0})
+        self.assertEqual(PaymentNotification.objects.get().status,
+            PaymentNotification.REJECTED)
+
+    def test_failed_notification_blocks_key(self):
+        self.postfinance_ipn('5')
+        self.postfinance_ipn('9')
+        PaymentNotification.objects.filter(pk=PaymentNotification.objects
+            .order_by('pk')[0].pk).update(payload='orderID=tree-%s'
+            % self.pledge.pk)
+
+        # The first one fails, the second one has to wait for it
+        self.assertEqual(process_notifications(),
+            {'processed': 0, 'duplicate': 0, 'rejected': 0, 'failed': 1})
+        self.assertEqual(process_notifications(),
+            {'processed': 0, 'duplicate': 0, 'rejected': 0, 'failed': 0})
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.UNAUTHORIZED)
+
+    def test_blocked_key_does_not_fill_batch(self):
+        other = PledgeFactory.create(project=self.project, amount=20,
+            status=Pledge.UNAUTHORIZED)
+        self.postfinance_ipn('5')
+        self.postfinance_ipn('9')
+        self.postfinance_ipn('5', order_id='tree-%s' % other.pk)
+        PaymentNotification.objects.filter(pk=PaymentNotification.objects
+            .order_by('pk')[0].pk).update(payload='orderID=tree-%s'
+            % self.pledge.pk)
+
+        self.assertEqual(process_notifications(batch_size=1)['failed'], 1)
+        # The waiting notification of the failed key is not selected
+        self.assertEqual(process_notifications(batch_size=1)['processed'], 1)
+        self.assertEqual(Pledge.objects.get(pk=other.pk).status,
+            Pledge.AUTHORIZED)
+
+    def test_paypal_ipn(self):
+        Preapproval.objects.create(pledge=self.pledge, key='PA-1', amount=20)
+        data = {
+            'transaction_type': 'Adaptive Payment PREAPPROVAL',
+            'preapproval_key': 'PA-1',
+            'status': 'ACTIVE',
+            'approved': 'true',
+            'sender_email': 'backer@example.com',
+        }
+        self.client.post('/paypal/ipn/', dict(data, verify_sign='INVALID'))
+        response = self.client.post('/paypal/ipn/', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PaymentNotification.objects.filter(
+            provider='paypal', key='PA-1').count(), 2)
+
+        cmd_url = paypal_api.client.cmd_url
+        try:
+            with StandInServer(PaypalHandler) as server:
+                paypal_api.client.cmd_url = server.url
+                results = process_notifications()
+        finally:
+            paypal_api.client.cmd_url = cmd_url
+
+        self.assertEqual(results,
+            {'processed': 1, 'duplicate': 0, 'rejected': 1, 'failed': 0})
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.AUTHORIZED)
+        self.assertEqual(Preapproval.objects.get().sender,
+            'backer@example.com')
+
+    def test_paypal_preapproval_canceled(self):
+        Preapproval.objects.create(pledge=self.pledge, key='PA-1', amount=20)
+        data = {
+            'transaction_type': 'Adaptive Payment PREAPPROVAL',
+            'preapproval_key': 'PA-1',
+            'approved': 'true',
+            'sender_email': 'backer@example.com',
+        }
+        self.client.post('/paypal/ipn/', dict(data, status='ACTIVE'))
+        self.client.post('/paypal/ipn/', dict(data, status='CANCELED',
+            approved='false'))
+        # Replayed activation
+        self.client.post('/paypal/ipn/', dict(data, status='ACTIVE',
+            approved='true', sender_email='replay@example.com'))
+
+        cmd_url = paypal_api.client.cmd_url
+        try:
+            with StandInServer(PaypalHandler) as server:
+                paypal_api.client.cmd_url = server.url
+                self.assertEqual(process_notifications()['processed'], 3)
+        finally:
+            paypal_api.client.cmd_url = cmd_url
+
+        preapproval = Preapproval.objects.get()
+        self.assertEqual(preapproval.status, 'CANCELED')
+        self.assertEqual(preapproval.sender, 'backer@example.com')
+        self.assertEqual(Pledge.objects.get(pk=self.pledge.pk).status,
+            Pledge.FAILED)
+        project = Project.objects.get(pk=self.project.pk)
+        self.assertEqual(project.achieved_amount, 0)
+        self.assertEqual(project.authorized_count, 0)
@@ -0,0 +1,96 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from feincms.module.page.models import Page
+from feincms.content.application.models import ApplicationContent
+
+from ..models import Pledge
+from ..paypal import app_settings as paypal_settings, paypal_api
+from ..paypal.models import Preapproval, Payment
+from ..paypal.tasks import process_payments, process_pledge
+from ..paypal.tasks import PaypalException
+from .. import app_settings
+
+from .factories import ProjectFactory, PledgeFactory
+from .servers import StandInServer, PaypalHandler
+
+
+class PaypalCollectTest(TestCase):
+
+    def setUp(self):
+        page = Page.objects.create(title='Projects', slug='projects')
+        page.content_type_for(ApplicationContent).objects.create(
+            parent=page, urlconf_path=app_settings.ROOT_URLS)
+
+        self.paypal_settings = paypal_settings.PAYPAL.copy()
+        paypal_settings.PAYPAL['RECEIVERS'] = [
+            {'email': 'owner@example.com', 'percent': 100}]
+        paypal_settings.PAYPAL['RATE_LIMIT'] = None
+        self.api_url = paypal_api.client.api_url
+        paypal_api.client.stats.clear()
+
+        self.project = ProjectFactory.create(
+            start=timezone.now() - timedelta(days=10),
+            end=timezone.now() - timedelta(hours=1),
+        )
+        for key in ('PA-1', 'PA-2', 'PA-3', 'FAIL-1'):
+            pledge = PledgeFactory.create(project=self.project, amount=100,
+                provider='paypal')
+            Preapproval.objects.create(pledge=pledge, key=key, amount=100,
+                status='ACTIVE', approved=True)
+
+    def tearDown(self):
+        paypal_settings.PAYPAL.clear()
+        paypal_settings.PAYPAL.update(self.paypal_settings)
+        paypal_api.client.api_url = self.api_url
+
+    def collect(self, workers):
+        with StandInServer(PaypalHandler) as server:
+            paypal_api.client.api_url = server.url
+            processed = process_payments(workers=workers)
+        self.assertEqual(len(server.requests), 4)
+        self.assertEqual(processed, 4)
+
+        self.assertEqual(sorted(Payment.objects.values_list('key', flat=True)),
+            ['AP-PA-1', 'AP-PA-2', 'AP-PA-3', 'ERROR_FAIL-1'])
+        self.assertEqual(
+            Pledge.objects.filter(status=Pledge.AUTHORIZED).count(), 3)
+        failed = Pledge.objects.get(status=Pledge.FAILED)
+        self.assertEqual(failed.paypal_preapproval.key, 'FAIL-1')
+
+        stats = paypal_api.client.stats['Pay']
+        self.assertEqual((stats['requests'], stats['errors']), (4, 0))
+
+    def test_collect_serial(self):
+        self.collect(workers=1)
+
+    def test_collect_concurrent(self):
+        self.collect(workers=3)
+
+    def collect_unreachable(self, workers):
+        # Nothing listens here, pledges are retried on the next run
+        with StandInServer(PaypalHandler) as server:
+            paypal_api.client.api_url = server.url
+        process_payments(workers=workers)
+
+        self.assertEqual(Payment.objects.count(), 0)
+        self.assertEqual(
+            Pledge.objects.filter(status=Pledge.AUTHORIZED).count(), 4)
+        self.assertEqual(paypal_api.client.stats['Pay']['errors'], 4)
+
+    def test_unreachable_api_serial(self):
+        self.collect_unreachable(workers=1)
+
+    def test_unreachable_api_concurrent(self):
+        self.collect_unreachable(workers=2)
+
+    def test_unreachable_api_single_pledge(self):
+        with StandInServer(PaypalHandler) as server:
+            paypal_api.client.api_url = server.url
+        pledge = Pledge.objects.get(paypal_preapproval__key='PA-1')
+        self.assertRaises(PaypalException, process_pledge, pledge)
+        self.assertEqual(Payment.objects.count(), 0)
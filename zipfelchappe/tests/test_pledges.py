@@ -1,10 +1,15 @@
 from datetime import timedelta
 
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils.timezone import now
 
 from django.core.exceptions import ValidationError
 
+from ..models import Project, Pledge, ExtraField, PledgeExtraValue
+from ..paginator import KeysetPaginator
+
 from .factories import ProjectFactory, PledgeFactory
 
 
@@ -21,3 +26,120 @@ class BasicPledgeTest(TestCase):
     def test_cannot_change_project_end_date(self):
         self.project.end = now() + timedelta(days=7)
         self.assertRaises(ValidationError, self.project.full_clean)
+
+    def test_status_never_moves_back(self):
+        self.p1.status = Pledge.UNAUTHORIZED
+        self.p1.save()
+        self.assertTrue(self.p1.update_status(Pledge.AUTHORIZED))
+        self.assertFalse(self.p1.update_status(Pledge.UNAUTHORIZED))
+        self.assertTrue(self.p1.update_status(Pledge.FAILED))
+        self.assertFalse(self.p1.update_status(Pledge.AUTHORIZED))
+        # A late payment of a failed collection
+        self.assertTrue(self.p1.update_status(Pledge.PAID))
+        self.assertFalse(self.p1.update_status(Pledge.FAILED))
+        self.assertEqual(Pledge.objects.get(pk=self.p1.pk).status, Pledge.PAID)
+
+
+class PledgeExtraDataTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+        self.shirt = ExtraField.objects.create(project=self.project,
+            title='Shirt size', name='shirt', type='text')
+        self.p1 = PledgeFactory.create(project=self.project, amount=10)
+        self.p2 = PledgeFactory.create(project=self.project, amount=10)
+
+    def test_extra_values(self):
+        self.p1.set_extra_data({'shirt': 'XL', 'newsletter': True})
+        self.p2.set_extra_data({'shirt': 'M'})
+
+        values = PledgeExtraValue.objects.filter(pledge=self.p1)
+        self.assertEqual(values.get(name='shirt').field, self.shirt)
+        self.assertEqual(values.get(name='newsletter').field, None)
+
+        pledges = Pledge.objects.filter(extra_values__name='shirt',
+            extra_values__value='XL')
+        self.assertEqual(list(pledges), [self.p1])
+
+        pledge = Pledge.objects.prefetch_related('extra_values').get(
+            pk=self.p1.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(pledge.extra_data,
+                {'shirt': 'XL', 'newsletter': 'True'})
+
+    def test_convert_extradata(self):
+        Pledge.objects.filter(pk=self.p1.pk).update(
+            extradata="{'shirt': u'L'}")
+        Pledge.objects.filter(pk=self.p2.pk).update(extradata='broken')
+        self.assertEqual(Pledge.objects.get(pk=self.p1.pk).extra_data,
+            {'shirt': 'L'})
+
+        call_command('convert_extradata')
+
+        pledge = Pledge.objects.get(pk=self.p1.pk)
+        self.assertEqual(pledge.extradata, '')
+        self.assertEqual(pledge.extra_values.get().value, 'L')
+        self.assertEqual(Pledge.objects.get(pk=self.p2.pk).extradata,
+            'broken')
+
+    def test_extraform_is_cached(self):
+        project = Project.objects.get(pk=self.project.pk)
+        form_class = project.extraform()
+        self.assertEqual(list(form_class.base_fields), ['shirt'])
+        with self.assertNumQueries(0):
+            self.assertIs(project.extraform(), form_class)
+
+        ExtraField.objects.create(project=self.project, title='Newsletter',
+            name='newsletter', type='checkbox')
+        project = Project.objects.get(pk=self.project.pk)
+        self.assertEqual(list(project.extraform().base_fields),
+            ['shirt', 'newsletter'])
+
+        self.shirt.delete()
+        project = Project.objects.get(pk=self.project.pk)
+        self.assertEqual(list(project.extraform().base_fields),
+            ['newsletter'])
+
+
+class KeysetPaginatorTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+        self.pledges = [
+            PledgeFactory.create(project=self.project, amount=10.00)
+            for i in range(5)
+        ]
+        # Same timestamp for all pledges, order must fall back to the id
+        Pledge.objects.update(created=now())
+
+    def test_pages_forward_and_back(self):
+        paginator = KeysetPaginator(self.project.public_pledges, 2)
+
+        first = paginator.page()
+        self.assertEqual(list(first), self.pledges[:2])
+        self.assertTrue(first.has_next())
+        self.assertFalse(first.has_previous())
+
+        second = paginator.page(after=first.next_cursor)
+        self.assertEqual(list(second), self.pledges[2:4])
+
+        last = paginator.page(after=second.next_cursor)
+        self.assertEqual(list(last), self.pledges[4:])
+        self.assertFalse(last.has_next())
+
+        back = paginator.page(before=last.previous_cursor)
+        self.assertEqual(list(back), self.pledges[2:4])
+        self.assertTrue(back.has_previous())
+
+    def test_invalid_cursor_returns_first_page(self):
+        paginator = KeysetPaginator(self.project.public_pledges, 2)
+        self.assertEqual(list(paginator.page(after='foo')), self.pledges[:2])
+
+    def test_without_time_zone_support(self):
+        with override_settings(USE_TZ=False):
+            paginator = KeysetPaginator(self.project.public_pledges, 2)
+            first = paginator.page()
+            second = paginator.page(after=first.next_cursor)
+            self.assertEqual(list(second), self.pledges[2:4])
+            back = paginator.page(before=second.previous_cursor)
+            self.assertEqual(list(back), self.pledges[:2])
@@ -0,0 +1,102 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import Pledge
+from ..postfinance.api import direct_link_v1
+from ..postfinance.models import Payment
+from ..postfinance.tasks import process_payments, process_pledge
+from ..postfinance.tasks import PostfinanceException
+
+from .factories import ProjectFactory, PledgeFactory
+from .servers import StandInServer, PostfinanceHandler
+
+
+class PostfinanceCollectTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create(
+            start=timezone.now() - timedelta(days=10),
+            end=timezone.now() - timedelta(hours=1),
+        )
+        self.base_url = direct_link_v1.client.base_url
+        direct_link_v1.client.stats.clear()
+
+    def tearDown(self):
+        direct_link_v1.client.base_url = self.base_url
+
+    def create_payment(self, payid, status):
+        pledge = PledgeFactory.create(project=self.project, amount=100,
+            provider='postfinance', status=Pledge.AUTHORIZED)
+        return Payment.objects.create(pledge=pledge,
+            order_id='test-%s' % payid, PAYID=payid, STATUS=status)
+
+    def test_pledges_are_loaded_in_chunks(self):
+        for i in range(5):
+            # Declined payments are skipped without contacting postfinance
+            self.create_payment(i, '2')
+
+        # Three chunks and the empty one at the end
+        with self.assertNumQueries(4):
+            self.assertEqual(process_payments(chunk_size=2), 5)
+
+    def collect(self, workers):
+        for payid in ('1', '2', '3', 'FAIL-1'):
+            self.create_payment(payid, '5')
+        self.create_payment('4', '91')
+
+        with StandInServer(PostfinanceHandler) as server:
+            direct_link_v1.client.base_url = server.url
+            processed = process_payments(chunk_size=2, workers=workers)
+        self.assertEqual(processed, 5)
+        self.assertEqual(sorted(path for method, path, body
+            in server.requests), ['/maintenancedirect.asp'] * 4 +
+            ['/querydirect.asp'])
+
+        self.assertEqual(dict(Payment.objects.values_list('PAYID', 'STATUS')),
+            {'1': '91', '2': '91', '3': '91', 'FAIL-1': '5', '4': '9'})
+        paid = Pledge.objects.get(status=Pledge.PAID)
+        self.assertEqual(paid.postfinance_payment.PAYID, '4')
+
+        stats = direct_link_v1.client.stats
+        self.assertEqual(stats['maintenancedirect.asp']['requests'], 4)
+        self.assertEqual(stats['querydirect.asp']['requests'], 1)
+
+    def test_collect_serial(self):
+        self.collect(workers=1)
+
+    def test_collect_concurrent(self):
+        self.collect(workers=3)
+
+    def unreachable_api(self, workers):
+        self.create_payment('1', '5')
+        self.create_payment('2', '91')
+
+        # Nothing listens here, pledges are retried on the next run
+        with StandInServer(PostfinanceHandler) as server:
+            direct_link_v1.client.base_url = server.url
+        process_payments(workers=workers)
+
+        self.assertEqual(dict(Payment.objects.values_list('PAYID', 'STATUS')),
+            {'1': '5', '2': '91'})
+        self.assertEqual(
+            Pledge.objects.filter(status=Pledge.AUTHORIZED).count(), 2)
+        stats = direct_link_v1.client.stats
+        self.assertEqual(stats['maintenancedirect.asp']['errors'], 1)
+        self.assertEqual(stats['querydirect.asp']['errors'], 1)
+
+    def test_unreachable_api_serial(self):
+        self.unreachable_api(workers=1)
+
+    def test_unreachable_api_concurrent(self):
+        self.unreachable_api(workers=2)
+
+    def test_unreachable_api_single_pledge(self):
+        self.create_payment('1', '91')
+        with StandInServer(PostfinanceHandler) as server:
+            direct_link_v1.client.base_url = server.url
+        self.assertRaises(PostfinanceException, process_pledge,
+            Pledge.objects.get())
@@ -5,8 +5,9 @@ from django.utils import timezone
 from django.test import TestCase
 
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 
-from ..models import Project, Pledge
+from ..models import Project, Pledge, Update
 
 from .factories import ProjectFactory, PledgeFactory
 
@@ -85,4 +86,116 @@ class BasicProjectTest(TestCase):
         self.assertFalse(self.project.is_financed)
         self.assertFalse(self.project.ended_successfully)
         self.assertEquals(self.project.update_count, 0)
-        self.assertEquals(len(self.project.public_pledges), 1)
\ No newline at end of file
+        self.assertEquals(len(self.project.public_pledges), 1)
+
+
+class FundingCounterTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+
+        self.p1 = PledgeFactory.create(
+            project=self.project,
+            amount=10.00,
+            status=Pledge.UNAUTHORIZED,
+        )
+
+    def reload(self):
+        return Project.objects.get(pk=self.project.pk)
+
+    def test_counters_follow_pledge_status(self):
+        self.assertEquals(self.reload().authorized_count, 0)
+
+        pledge = Pledge.objects.get(pk=self.p1.pk)
+        pledge.status = Pledge.AUTHORIZED
+        pledge.save()
+        project = self.reload()
+        self.assertEquals(project.achieved, Decimal('10.00'))
+        self.assertEquals(project.authorized_count, 1)
+        self.assertEquals(project.public_backer_count, 1)
+
+        pledge.status = Pledge.PAID
+        pledge.save()
+        self.assertEquals(self.reload().achieved, Decimal('10.00'))
+
+        pledge.status = Pledge.FAILED
+        pledge.save()
+        project = self.reload()
+        self.assertEquals(project.achieved, Decimal('0.00'))
+        self.assertEquals(project.authorized_count, 0)
+
+    def test_counters_on_delete(self):
+        p2 = PledgeFactory.create(project=self.project, amount=20.00,
+            anonymously=True)
+        project = self.reload()
+        self.assertEquals(project.achieved, Decimal('20.00'))
+        self.assertEquals(project.public_backer_count, 0)
+
+        p2.delete()
+        self.assertEquals(self.reload().authorized_count, 0)
+
+    def test_project_save_keeps_counters(self):
+        stale = self.reload()
+        PledgeFactory.create(project=self.project, amount=20.00)
+        stale.title = 'Renamed'
+        stale.save()
+        self.assertEquals(self.reload().achieved, Decimal('20.00'))
+
+    def test_update_funding_counters(self):
+        PledgeFactory.create(project=self.project, amount=20.00)
+        Project.objects.update(achieved_amount=0, authorized_count=0)
+
+        call_command('update_funding_counters')
+        project = self.reload()
+        self.assertEquals(project.achieved, Decimal('20.00'))
+        self.assertEquals(project.authorized_count, 1)
+        self.assertEquals(project.public_backer_count, 1)
+
+
+class ProjectStatsTest(TestCase):
+
+    def setUp(self):
+        for i in range(3):
+            project = ProjectFactory.create()
+            PledgeFactory.create(project=project, amount=50.00)
+            Update.objects.create(project=project, title='News',
+                status=Update.STATUS_PUBLISHED)
+            Update.objects.create(project=project, title='Draft')
+
+    def test_with_stats_uses_one_query(self):
+        with self.assertNumQueries(1):
+            for project in Project.objects.online().with_stats():
+                self.assertEquals(project.update_count, 1)
+                self.assertEquals(project.achieved, Decimal('50.00'))
+                self.assertEquals(project.percent, 25)
+                self.assertFalse(project.is_financed)
+
+
+class BillableProjectsTest(TestCase):
+
+    def setUp(self):
+        ended = dict(start=timezone.now() - timedelta(days=2),
+                     end=timezone.now() - timedelta(days=1))
+        self.financed = ProjectFactory.create(**ended)
+        self.pledge = PledgeFactory.create(project=self.financed,
+            amount=200.00, status=Pledge.AUTHORIZED)
+
+        self.unfinanced = ProjectFactory.create(**ended)
+        PledgeFactory.create(project=self.unfinanced, amount=100.00,
+            status=Pledge.AUTHORIZED)
+
+        running = ProjectFactory.create()
+        PledgeFactory.create(project=running, amount=200.00,
+            status=Pledge.AUTHORIZED)
+
+    def test_billable(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Project.objects.billable()),
+                [self.financed])
+
+        billable = Project.objects.billable(exclude_processed=True)
+        self.assertEqual(list(billable), [self.financed])
+        self.pledge.status = Pledge.PAID
+        self.pledge.save()
+        self.assertEqual(list(billable.all()), [])
+        self.assertEqual(list(Project.objects.billable()), [self.financed])
@@ -1,7 +1,11 @@
+from datetime import timedelta
+
 from django.test import TestCase
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.utils.timezone import now
 
-from ..models import Reward
+from ..models import Reward, Pledge, RewardUnavailable
 
 from .factories import ProjectFactory, RewardFactory, PledgeFactory
 
@@ -61,3 +65,78 @@ class BasicRewardTest(TestCase):
         # That's too low
         self.reward.quantity = 1
         self.assertRaises(ValidationError, self.reward.full_clean)
+
+    def test_quantity_below_held(self):
+        PledgeFactory.create(project=self.project, amount=20.00,
+            reward=self.reward, status=Pledge.UNAUTHORIZED)
+        reward = Reward.objects.get(pk=self.reward.pk)
+        self.assertEqual((reward.awarded, reward.claimed), (1, 2))
+
+        # The held unit cannot be taken away
+        reward.quantity = 1
+        self.assertRaises(ValidationError, reward.full_clean)
+        reward.quantity = 2
+        reward.full_clean()
+
+
+class RewardReservationTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+        self.reward = RewardFactory.create(
+            project=self.project,
+            minimum=20.00,
+            quantity=2
+        )
+
+    def pledge(self, status=Pledge.UNAUTHORIZED):
+        return PledgeFactory.create(project=self.project, amount=20.00,
+            reward=self.reward, status=status)
+
+    def claimed(self):
+        return Reward.objects.get(pk=self.reward.pk).claimed
+
+    def test_pledges_hold_reward(self):
+        self.pledge()
+        self.pledge()
+        self.assertEqual(self.claimed(), 2)
+        self.assertFalse(self.reward.is_available)
+        self.assertRaises(RewardUnavailable, self.pledge)
+        self.assertEqual(Pledge.objects.count(), 2)
+
+    def test_failed_pledge_releases_reward(self):
+        pledge = self.pledge()
+        pledge.status = Pledge.FAILED
+        pledge.save()
+        self.assertEqual(self.claimed(), 0)
+
+    def test_changed_reward(self):
+        pledge = self.pledge()
+        other = RewardFactory.create(project=self.project, minimum=10.00)
+        pledge.reward = other
+        pledge.save()
+        self.assertEqual(self.claimed(), 0)
+        self.assertEqual(Reward.objects.get(pk=other.pk).claimed, 1)
+
+    def test_expired_hold(self):
+        pledge = self.pledge()
+        authorized = self.pledge(status=Pledge.AUTHORIZED)
+        Pledge.objects.update(modified=now() - timedelta(days=1))
+
+        call_command('release_reward_holds')
+        self.assertEqual(self.claimed(), 1)
+        self.assertTrue(Pledge.objects.get(pk=authorized.pk).reward_claimed)
+
+        # Saving again does not renew the hold, authorizing does
+        pledge = Pledge.objects.get(pk=pledge.pk)
+        pledge.save()
+        self.assertEqual(self.claimed(), 1)
+        pledge.status = Pledge.AUTHORIZED
+        pledge.save()
+        self.assertEqual(self.claimed(), 2)
+
+    def test_release_reward(self):
+        pledge = self.pledge()
+        self.assertTrue(pledge.release_reward())
+        self.assertFalse(pledge.release_reward())
+        self.assertEqual(self.claimed(), 0)
@@ -0,0 +1,39 @@
+from __future__ import unicode_literals, absolute_import
+from django.test import TestCase
+from django.utils import translation
+
+from ..models import Project
+from ..translations.models import ProjectTranslation, RewardTranslation
+
+from .factories import ProjectFactory, RewardFactory
+
+
+class TranslationLoaderTest(TestCase):
+
+    def setUp(self):
+        self.project1 = ProjectFactory.create(title='Tree house')
+        self.project2 = ProjectFactory.create(title='Boat')
+        self.reward1 = RewardFactory.create(project=self.project1,
+            minimum=10.00, description='A postcard')
+        self.reward2 = RewardFactory.create(project=self.project1,
+            minimum=20.00, description='A poster')
+
+        translation = ProjectTranslation.objects.create(
+            translation_of=self.project1, lang='de', title='Baumhaus')
+        RewardTranslation.objects.create(translation=translation,
+            translation_of=self.reward1, description='Eine Postkarte')
+
+    def test_project_translations(self):
+        with translation.override('de'):
+            with self.assertNumQueries(2):
+                projects = list(Project.objects.with_translations())
+                titles = [p.translated.title for p in projects]
+
+        self.assertEqual(titles, ['Baumhaus', 'Boat'])
+
+    def test_reward_translations(self):
+        rewards = self.project1.rewards.with_translations('de')
+        with self.assertNumQueries(2):
+            descriptions = [r.translated.description for r in rewards]
+
+        self.assertEqual(descriptions, ['Eine Postkarte', 'A poster'])
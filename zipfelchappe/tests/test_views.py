@@ -1,8 +1,15 @@
 from __future__ import absolute_import, unicode_literals
+import json
+from datetime import timedelta
+
 from django.core import mail
-from django.db import models
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 from django.contrib.auth.models import User
 
 
@@ -13,8 +20,10 @@ from bs4 import BeautifulSoup
 
 
 from .factories import ProjectFactory, RewardFactory, PledgeFactory, UserFactory
-from ..models import Backer, Pledge
-from .. import app_settings
+from ..models import Backer, Pledge, Project, Reward
+from ..utils import run_commit_callbacks
+from ..views import get_project_status, get_session_pledge
+from .. import app_settings, views
 
 
 class PledgeWorkflowTest(TestCase):
@@ -37,10 +46,16 @@ class PledgeWorkflowTest(TestCase):
 
         # Fresh Client for every test
         self.client = Client()
+        cache.clear()
 
     def tearDown(self):
+        run_commit_callbacks(committed=False)
         mail.outbox = []
 
+    def commit(self):
+        """ Runs the callbacks that wait for the test transaction """
+        run_commit_callbacks()
+
     def assertRedirect(self, response, expected_url):
         """ Just check immediate redirect, don't follow target url """
         full_url = ('Location', 'http://testserver' + expected_url)
@@ -62,6 +77,43 @@ class PledgeWorkflowTest(TestCase):
         project1_url = self.project1.get_absolute_url()
         self.assertEqual(project_links[0]['href'], project1_url)
 
+    def test_project_list_is_cached(self):
+        r = self.client.get('/projects/')
+        self.assertContains(r, self.project1.title)
+
+        # Changes that send no signals are not picked up
+        Project.objects.filter(pk=self.project1.pk).update(title='Renamed')
+        r = self.client.get('/projects/')
+        self.assertNotContains(r, 'Renamed')
+
+        # An authorized pledge changes the achieved amount of the project
+        PledgeFactory.create(project=self.project1, amount=10.00,
+            status=Pledge.AUTHORIZED)
+        self.commit()
+        r = self.client.get('/projects/')
+        self.assertContains(r, '10 CHF')
+
+    def test_project_list_after_end(self):
+        self.client.get('/projects/')
+
+        # Ending does not change the project version of the teaser
+        Project.objects.filter(pk=self.project1.pk).update(
+            end=now() - timedelta(minutes=1))
+        r = self.client.get('/projects/')
+        soup = BeautifulSoup(r.content)
+        teaser = soup.find('a', href=self.project1.get_absolute_url())
+        self.assertEqual(teaser.find('span', 'remaining').text,
+            '0\xa0minutes')
+        self.assertIn('finished', teaser['class'])
+        self.assertIn('progress-warning', teaser.find('div', 'progress')[
+            'class'])
+
+    def test_project_list_page_numbers(self):
+        r = self.client.get('/projects/?page=last')
+        self.assertContains(r, self.project1.title)
+        r = self.client.get('/projects/?page=junk')
+        self.assertEqual(r.status_code, 404)
+
     def test_project_detail(self):
         """ Check if project detail page infos are correct """
         r = self.client.get(self.project1.get_absolute_url())
@@ -76,6 +128,135 @@ class PledgeWorkflowTest(TestCase):
         back_button = soup.find(id='back_button')
         self.assertIsNotNone(back_button)
 
+    def test_project_detail_sidebar_is_cached(self):
+        url = self.project1.get_absolute_url()
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as cached:
+            r = self.client.get(url)
+        self.assertLess(len(cached), len(first))
+        self.assertContains(r, self.reward.description)
+
+        self.reward.description = 'A signed poster'
+        self.reward.save()
+        self.commit()
+        r = self.client.get(url)
+        self.assertContains(r, 'A signed poster')
+
+        r = self.client.get('/projects/back/%s/' % self.project1.slug)
+        self.assertContains(r, '( 1 / 1 )')
+        PledgeFactory.create(project=self.project1, amount=20.00,
+            reward=self.reward)
+        self.commit()
+        r = self.client.get('/projects/back/%s/' % self.project1.slug)
+        self.assertContains(r, '( 0 / 1 )')
+
+    def test_project_detail_sidebar_after_end(self):
+        url = self.project1.get_absolute_url()
+        r = self.client.get(url)
+        self.assertContains(r, 'id="back_button"')
+
+        # Ending does not change the project version of the fragment
+        Project.objects.filter(pk=self.project1.pk).update(
+            end=now() - timedelta(minutes=1))
+        r = self.client.get(url)
+        self.assertNotContains(r, 'id="back_button"')
+        soup = BeautifulSoup(r.content)
+        self.assertEqual(soup.find('span', 'remaining').text, '0\xa0minutes')
+
+    def test_conditional_get(self):
+        url = self.project1.get_absolute_url()
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        etag, last_modified = r['ETag'], r['Last-Modified']
+
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        r = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(r.status_code, 304)
+
+        # New funding state
+        PledgeFactory.create(project=self.project1, amount=10.00,
+            status=Pledge.AUTHORIZED)
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], etag)
+        etag = r['ETag']
+
+        r = self.client.get('/projects/')
+        r = self.client.get('/projects/', HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(r.status_code, 304)
+
+        # Logged in users always get the full page
+        self.client.login(username=self.user.username, password='test')
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse(r.has_header('ETag'))
+
+    def test_project_status(self):
+        url = '/projects/project/%s/status/' % self.project1.slug
+        r = self.client.get(url)
+        self.assertEqual(r['Content-Type'], 'application/json')
+        status = json.loads(r.content)
+        self.assertEqual(status['achieved'], 0)
+        self.assertEqual(status['backers'], 0)
+        self.assertEqual(status['end'], self.project1.end.isoformat())
+        remaining = (self.project1.end - now()).total_seconds()
+        self.assertEqual(status['remaining'] % 60, 0)
+        self.assertTrue(remaining - 120 < status['remaining'] <= remaining + 1)
+        self.assertEqual(status['rewards'], [{'id': self.reward.pk,
+            'minimum': 20, 'quantity': 1, 'available': 1}])
+
+        etag = r['ETag']
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+
+        # The remaining time and so the etag change every minute
+        views_now = views.now
+        views.now = lambda: views_now() + timedelta(minutes=1)
+        try:
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        finally:
+            views.now = views_now
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(json.loads(r.content)['remaining'],
+            (status['remaining'] - 60, status['remaining'] - 120))
+
+        PledgeFactory.create(project=self.project1, amount=20.00,
+            reward=self.reward, status=Pledge.AUTHORIZED)
+        self.commit()
+        with self.assertNumQueries(1):
+            get_project_status(self.project1.slug)
+        with self.assertNumQueries(0):
+            get_project_status(self.project1.slug)
+        r = self.client.get(url)
+        status = json.loads(r.content)
+        self.assertEqual(status['achieved'], 20)
+        self.assertEqual(status['backers'], 1)
+        self.assertEqual(status['rewards'][0]['available'], 0)
+
+        # Authorized payments get their reward even if it is given away
+        PledgeFactory.create(project=self.project1, amount=20.00,
+            reward=self.reward, status=Pledge.AUTHORIZED)
+        self.commit()
+        status = get_project_status(self.project1.slug)
+        self.assertEqual(status['rewards'][0]['available'], 0)
+
+        self.assertEqual(self.client.get(
+            '/projects/project/unknown/status/').status_code, 404)
+
+    def test_project_detail_backers(self):
+        """ Public backers are listed on the backers tab """
+        PledgeFactory.create(project=self.project1, amount=10.00)
+        PledgeFactory.create(project=self.project1, amount=10.00,
+            anonymously=True)
+
+        r = self.client.get(self.project1.get_absolute_url())
+        soup = BeautifulSoup(str(r))
+        backers = soup.find(id='backers')
+        self.assertEqual(1, len(backers.find('ul').find_all('li')))
+        self.assertIsNone(backers.find('a'))
+
     def test_back_project(self):
         """ Does the back form show up the right way? """
         r = self.client.get('/projects/back/%s/' % self.project1.slug)
@@ -112,6 +293,30 @@ class PledgeWorkflowTest(TestCase):
         })
         self.assertContains(r, 'Sorry, this reward is not available anymore.')
 
+    def test_edit_pledge_holding_last_reward(self):
+        # The backer goes back to the form after taking the last unit
+        self.client.post('/projects/back/%s/' % self.project1.slug, {
+            'project': self.project1.id,
+            'amount': '20',
+            'reward': self.reward.id,
+            'provider': 'paypal'
+        })
+        pledge = Pledge.objects.get(pk=self.client.session['pledge_id'])
+        self.assertTrue(pledge.reward_claimed)
+
+        r = self.client.post('/projects/back/%s/' % self.project1.slug, {
+            'project': self.project1.id,
+            'amount': '30',
+            'reward': self.reward.id,
+            'provider': 'paypal'
+        })
+        self.assertRedirect(r, '/projects/backer/authenticate/')
+
+        pledge = Pledge.objects.get(pk=pledge.pk)
+        self.assertEqual(pledge.amount, 30)
+        self.assertTrue(pledge.reward_claimed)
+        self.assertEqual(Reward.objects.get(pk=self.reward.pk).claimed, 1)
+
     def test_pledge_with_login(self):
         # Submit pledge data
         r = self.client.post('/projects/back/%s/' % self.project1.slug, {
@@ -266,7 +471,9 @@ class PledgeWorkflowTest(TestCase):
         self.assertRedirect(response, '/projects/project/%s/backed/' % self.project1.slug)
         self.assertNotIn('pledge_id', self.client.session)
         self.assertIn('completed_pledge_id', self.client.session)
-        # test mail has been sent.
+        # test mail has been queued and is sent by the worker
+        self.assertEqual(len(mail.outbox), 0)
+        call_command('send_queued_mails')
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].subject, 'Thank you for supporting %s' % pledge.project)
 
@@ -275,3 +482,27 @@ class PledgeWorkflowTest(TestCase):
         self.assertNotIn('pledge_id', self.client.session)
         self.assertNotIn('completed_pledge_id', self.client.session)
         self.assertContains(response, self.project1.title)
+
+
+class SessionPledgeTest(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create()
+        self.p1 = PledgeFactory.create(project=self.project, amount=10)
+        self.p2 = PledgeFactory.create(project=self.project, amount=20)
+
+    def test_pledge_is_loaded_once_per_request(self):
+        request = RequestFactory().get('/')
+        request.session = {'pledge_id': self.p1.pk}
+
+        with self.assertNumQueries(1):
+            pledge = get_session_pledge(request)
+            self.assertEqual(pledge, self.p1)
+            self.assertIs(get_session_pledge(request), pledge)
+            self.assertEqual(pledge.project, self.project)
+
+        request.session['pledge_id'] = self.p2.pk
+        self.assertEqual(get_session_pledge(request), self.p2)
+
+        del request.session['pledge_id']
+        self.assertIsNone(get_session_pledge(request))
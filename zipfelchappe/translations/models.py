@@ -1,10 +1,18 @@
 
+from functools import partial
+
 from django.conf import settings
 from django.db import models
+from django.db.models import signals
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 from feincms.models import Base
 
+from zipfelchappe.cache import bump_version, project_namespace
+from zipfelchappe.cache import invalidate_project_lists
+from zipfelchappe.utils import on_commit
+
 
 class ProjectTranslation(Base):
 
@@ -96,3 +104,45 @@ class MailTemplateTranslation(models.Model):
     def __unicode__(self):
         return u'%s (%s)' % (self.translation_of,
             self.translation.get_lang_display())
+
+    def save(self, *args, **kwargs):
+        super(MailTemplateTranslation, self).save(*args, **kwargs)
+        self.touch_mail_template()
+
+    def delete(self, *args, **kwargs):
+        super(MailTemplateTranslation, self).delete(*args, **kwargs)
+        self.touch_mail_template()
+
+    def touch_mail_template(self):
+        """ Compiled mail templates are cached by the modification time of
+            the mail template, so changing a translation has to change it """
+        from zipfelchappe.models import MailTemplate
+        MailTemplate.objects.filter(pk=self.translation_of_id).update(
+            modified=now())
+
+
+def touch_project(project_id):
+    """ Project pages are revalidated by the modification time of the
+        project, so changing a translation has to change it """
+    from zipfelchappe.models import Project
+    Project.objects.filter(pk=project_id).update(modified=now())
+    on_commit(partial(bump_version, project_namespace(project_id)))
+
+
+def project_translation_changed(sender, instance, **kwargs):
+    touch_project(instance.translation_of_id)
+
+
+def reward_translation_changed(sender, instance, **kwargs):
+    touch_project(instance.translation.translation_of_id)
+
+
+def update_translation_changed(sender, instance, **kwargs):
+    touch_project(instance.translation.translation_of_id)
+
+
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(invalidate_project_lists, sender=ProjectTranslation)
+    signal.connect(project_translation_changed, sender=ProjectTranslation)
+    signal.connect(reward_translation_changed, sender=RewardTranslation)
+    signal.connect(update_translation_changed, sender=UpdateTranslation)
@@ -12,6 +12,9 @@ urlpatterns = patterns('',
     url(r'^project/(?P<slug>[\w-]+)/$',
         views.ProjectDetailView.as_view(),
         name='zipfelchappe_project_detail'),
+    url(r'^project/(?P<slug>[\w-]+)/status/$',
+        views.project_status,
+        name='zipfelchappe_project_status'),
     url(r'^project/(?P<slug>[\w-]+)/backed/$',
         views.ProjectDetailHasBackedView.as_view(),
         name='zipfelchappe_project_backed'),
@@ -1,6 +1,10 @@
+import threading
+import time
+from collections import OrderedDict
 
 from django.conf import settings
-from django.db import models
+from django.core.signals import request_finished
+from django.db import models, transaction
 from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
@@ -34,4 +38,124 @@ def get_object_or_none(klass, *args, **kwargs):
     try:
         return queryset.get(*args, **kwargs)
     except (queryset.model.DoesNotExist, ValueError):
-        return None
\ No newline at end of file
+        return None
+
+
+class LRUCache(object):
+    """
+    A small process local cache that drops the least recently used entries
+    once it holds more than maxsize entries.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, predicate):
+        """ Removes all entries whose key matches predicate """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so that at most rate calls per second pass,
+    no matter how many threads share the limiter. A rate of None or 0 turns
+    the limit off.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            current = time.time()
+            scheduled = max(self._next, current)
+            self._next = scheduled + self.interval
+        if scheduled > current:
+            time.sleep(scheduled - current)
+
+
+def on_commit(func, using=None):
+    """
+    Calls func once the current transaction has been committed, or right
+    away outside of transactions. Django 1.6 has no such hook, the callbacks
+    are run by zipfelchappe.utils.atomic when the outermost block has been
+    committed. Callbacks queued below atomic blocks of other code, e.g. the
+    admin views, are run when the request has finished. The callbacks should
+    only invalidate or notify, as they may also run after a rollback there.
+    """
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block:
+        pending = connection.__dict__.setdefault('zipfelchappe_on_commit', [])
+        pending.append(func)
+    else:
+        func()
+
+
+def run_commit_callbacks(using=None, committed=True):
+    """ Runs the queued callbacks of the connection, or drops them if the
+        transaction has not been committed """
+    connection = transaction.get_connection(using)
+    pending = connection.__dict__.pop('zipfelchappe_on_commit', [])
+    if committed:
+        for func in pending:
+            func()
+
+
+class atomic(object):
+    """ transaction.atomic that runs the on_commit callbacks after the
+        outermost block has been committed """
+
+    def __init__(self, using=None):
+        self.using = using
+        self.atomic = transaction.atomic(using)
+
+    def __enter__(self):
+        self.atomic.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        committed = False
+        try:
+            self.atomic.__exit__(exc_type, exc_value, traceback)
+            committed = exc_type is None
+        finally:
+            if not transaction.get_connection(self.using).in_atomic_block:
+                run_commit_callbacks(self.using, committed)
+
+
+def run_finished_request_callbacks(sender, **kwargs):
+    if not transaction.get_connection().in_atomic_block:
+        run_commit_callbacks()
+
+
+request_finished.connect(run_finished_request_callbacks)
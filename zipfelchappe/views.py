@@ -1,5 +1,7 @@
+import hashlib
+import json
+from calendar import timegm
 from functools import wraps
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 
 from django.shortcuts import get_object_or_404, redirect as _redirect
 from django.views.generic import ListView, DetailView, FormView, TemplateView
@@ -7,16 +9,29 @@ from django.views.generic import ListView, DetailView, FormView, TemplateView
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import AuthenticationForm
+from django.core.cache import cache
+from django.core.exceptions import NON_FIELD_ERRORS
 from django.core.urlresolvers import NoReverseMatch
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.http import StreamingHttpResponse
+from django.utils.http import parse_etags, parse_http_date_safe, quote_etag
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import get_language
+from django.views.decorators.http import require_safe
 
 from feincms.content.application.models import app_reverse
 from feincms.module.mixins import ContentView
 
 from . import forms, app_settings
-from .emails import send_pledge_completed_message
+from .cache import fragment_key, get_version, project_namespace
+from .emails import queue_pledge_completed_message
+from .events import event_stream, get_broker
 from .models import Project, Pledge, Backer, Category, Update
-from .utils import get_object_or_none
+from .models import RewardUnavailable
+from .paginator import KeysetPaginator
+from .utils import atomic, get_object_or_none
 
 
 #-----------------------------------
@@ -24,12 +39,21 @@ from .utils import get_object_or_none
 #-----------------------------------
 
 def get_session_pledge(request):
-    """ returns the last created pledge for the current session or None """
+    """ returns the last created pledge for the current session or None.
+        The pledge is loaded once per request and reloaded only if the
+        pledge_id in the session changes. """
 
     pledge_id = request.session.get('pledge_id', None)
-    if pledge_id:
-        return get_object_or_none(Pledge, pk=pledge_id)
-    return None
+    if not pledge_id:
+        return None
+
+    cached = getattr(request, '_zipfelchappe_pledge', None)
+    if cached is None or cached[0] != pledge_id:
+        pledge = get_object_or_none(
+            Pledge.objects.select_related('project', 'backer', 'reward'),
+            pk=pledge_id)
+        cached = request._zipfelchappe_pledge = (pledge_id, pledge)
+    return cached[1]
 
 
 def requires_pledge(func):
@@ -68,7 +92,9 @@ class PledgeContextMixin(object):
     def get_context_data(self, *args, **kwargs):
         context = super(PledgeContextMixin, self).get_context_data(*args, **kwargs)
 
-        pledge = getattr(self, 'pledge', get_session_pledge(self.request))
+        pledge = getattr(self, 'pledge', None)
+        if pledge is None:
+            pledge = get_session_pledge(self.request)
 
         if pledge:
             context.update({
@@ -79,6 +105,59 @@ class PledgeContextMixin(object):
         return context
 
 
+class ConditionalGetMixin(object):
+    """ Answers revalidations of anonymous visitors with 304 Not Modified
+        before anything is rendered. The validators are added to the page
+        response by zipfelchappe.middleware.ConditionalGetMiddleware. """
+
+    conditional_get = True
+
+    def get_last_modified(self):
+        """ Returns the time the content of this view changed last, or None
+            if only the etag parts and the hour tell whether it changed """
+        return None
+
+    def get_etag_parts(self):
+        return []
+
+    def get_object(self, *args, **kwargs):
+        # Loaded once for the validators and the view
+        if not hasattr(self, '_object'):
+            self._object = super(ConditionalGetMixin, self).get_object(
+                *args, **kwargs)
+        return self._object
+
+    def dispatch(self, request, *args, **kwargs):
+        # Pending messages have to be rendered
+        if not self.conditional_get or request.method not in ('GET', 'HEAD') \
+                or request.user.is_authenticated() \
+                or len(messages.get_messages(request)):
+            return super(ConditionalGetMixin, self).dispatch(
+                request, *args, **kwargs)
+
+        self.request, self.args, self.kwargs = request, args, kwargs
+
+        # Remaining times are shown, so pages change every hour at least
+        hour = now().replace(minute=0, second=0, microsecond=0)
+        last_modified = max(self.get_last_modified() or hour, hour)
+        etag = hashlib.md5(repr([get_language(), last_modified.isoformat()]
+            + self.get_etag_parts())).hexdigest()
+        request.zipfelchappe_validators = (etag, last_modified)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_none_match:
+            if etag in parse_etags(if_none_match):
+                return HttpResponseNotModified()
+        elif if_modified_since and \
+                if_modified_since >= timegm(last_modified.utctimetuple()):
+            return HttpResponseNotModified()
+
+        return super(ConditionalGetMixin, self).dispatch(
+            request, *args, **kwargs)
+
+
 class FeincmsRenderMixin(object):
     """ This is required to use django template inheritance with CBVs """
 
@@ -86,6 +165,14 @@ class FeincmsRenderMixin(object):
         return self.get_template_names(), context
 
 
+def project_cache_context(project):
+    """ Context to cache the fragments of a single project """
+    return {
+        'cache_timeout': app_settings.CACHE_TIMEOUT,
+        'project_cache_key': fragment_key(project_namespace(project.pk)),
+    }
+
+
 def reverse(view_name, *args, **kwargs):
     """ Reverse within our app context """
     return app_reverse(view_name, app_settings.ROOT_URLS, args=args, kwargs=kwargs)
@@ -103,7 +190,7 @@ def redirect(view_name, *args, **kwargs):
 # views
 #-----------------------------------
 
-class ProjectListView(FeincmsRenderMixin, ListView):
+class ProjectListView(ConditionalGetMixin, FeincmsRenderMixin, ListView):
     """ List view of all projects that are active or finished.
         To change pagination count set ZIPFELCHAPPE_PAGINATE_BY in settings.
     """
@@ -111,25 +198,46 @@ class ProjectListView(FeincmsRenderMixin, ListView):
     paginate_by = app_settings.PAGINATE_BY
     model = Project
 
+    def get_projects(self):
+        return Project.objects.online()
+
     def get_queryset(self):
-        return Project.objects.online().select_related()
+        return self.get_projects().with_stats().with_translations()
+
+    def get_last_modified(self):
+        projects = self.get_projects().aggregate(
+            modified=Max('modified'), count=Count('id'))
+        categories = Category.objects.aggregate(
+            modified=Max('modified'), count=Count('id'))
+        # Counts change if a project goes online or something is deleted
+        self.counts = [projects['count'], categories['count']]
+        modified = [m for m in (projects['modified'], categories['modified'])
+                    if m is not None]
+        return max(modified) if modified else None
+
+    def get_etag_parts(self):
+        return self.counts
 
     def get_context_data(self, **kwargs):
         context = super(ProjectListView, self).get_context_data(**kwargs)
-        context['category_list'] = Category.objects.all()
+        context.update({
+            'cache_timeout': app_settings.CACHE_TIMEOUT,
+            'category_cache_key': fragment_key('projects'),
+            # Only evaluated if the category sidebar is not cached
+            'category_list': Category.objects.all(),
+        })
         return context
 
 
 class ProjectCategoryListView(ProjectListView):
     """ Filtered project list view for only one category """
 
-    def get_queryset(self):
+    def get_projects(self):
         category = get_object_or_404(Category, slug=self.kwargs['slug'])
-        online_projects = Project.objects.online().select_related()
-        return online_projects.filter(categories=category)
+        return Project.objects.online().filter(categories=category)
 
 
-class ProjectDetailView(FeincmsRenderMixin, ContentView):
+class ProjectDetailView(ConditionalGetMixin, FeincmsRenderMixin, ContentView):
     """ Show status, description, updates, backers and comments of a project """
 
     context_object_name = "project"
@@ -139,38 +247,49 @@ class ProjectDetailView(FeincmsRenderMixin, ContentView):
         # limit queryset to projects that have started.
         return Project.objects.online().select_related('rewards')
 
+    def get_last_modified(self):
+        return self.get_object().modified
+
     def get_context_data(self, **kwargs):
         context = super(ProjectDetailView, self).get_context_data(**kwargs)
         context['disqus_shortname'] = app_settings.DISQUS_SHORTNAME
         context['updates'] = context['project'].updates.filter(
             status=Update.STATUS_PUBLISHED
-        )
+        ).with_translations()
+        # Only evaluated if the sidebar is not cached
+        context['rewards'] = context['project'].rewards.with_translations()
+        context.update(project_cache_context(context['project']))
         # create a paginated list of backers.
-        backers = context['project'].public_pledges
-        paginator = Paginator(backers, app_settings.PAGINATE_BACKERS_BY)
-        context['backer_count'] = len(backers)
-        page = int(self.request.GET.get('backers-page', 1))
-        try:
-            context['pledges'] = paginator.page(page)
-        except PageNotAnInteger:
-            # If page is not an integer, deliver first page.
-            context['pledges'] = paginator.page(1)
-        except EmptyPage:
-            # If page is out of range (e.g. 9999), deliver last page of results.
-            context['pledges'] = paginator.page(paginator.num_pages)
+        backers = context['project'].public_pledges.select_related(
+            'backer', 'backer__user')
+        paginator = KeysetPaginator(backers, app_settings.PAGINATE_BACKERS_BY)
+        context['backer_count'] = context['project'].public_backer_count
+        context['pledges'] = paginator.page(
+            after=self.request.GET.get('backers-after'),
+            before=self.request.GET.get('backers-before'),
+        )
 
         return context
 
 
-class UpdateDetailView(FeincmsRenderMixin, DetailView):
+class UpdateDetailView(ConditionalGetMixin, FeincmsRenderMixin, DetailView):
     """ Just a simple view of one project update for preview purposes """
 
     context_object_name = 'update'
     model = Update
 
+    def get_queryset(self):
+        return Update.objects.select_related('project')
+
+    def get_last_modified(self):
+        update = self.get_object()
+        return max(update.modified, update.project.modified)
+
     def get_context_data(self, **kwargs):
         context = super(UpdateDetailView, self).get_context_data(**kwargs)
-        context['project'] = self.get_object().project
+        context['project'] = self.object.project
+        context['rewards'] = self.object.project.rewards.with_translations()
+        context.update(project_cache_context(self.object.project))
         return context
 
 
@@ -179,6 +298,9 @@ class ProjectDetailHasBackedView(ProjectDetailView):
 
     template_name = 'zipfelchappe/project_has_backed.html'
 
+    # Shows the pledge that has just been completed
+    conditional_get = False
+
     def get_queryset(self):
         return Project.objects.online()
 
@@ -192,6 +314,111 @@ class ProjectDetailHasBackedView(ProjectDetailView):
 
         return context
 
+
+def load_project_status(slug):
+    """ Loads the funding status of an online project with a single query.
+        Raises Http404 for unknown projects. """
+    rows = Project.objects.online().filter(slug=slug).order_by(
+        'rewards__minimum', 'rewards__id').values(
+        'id', 'goal', 'currency', 'end', 'achieved_amount', 'authorized_count',
+        'rewards__id', 'rewards__minimum', 'rewards__quantity',
+        'rewards__claimed')
+    if not rows:
+        raise Http404
+    project = rows[0]
+
+    rewards = []
+    for row in rows:
+        if row['rewards__id'] is None:
+            continue
+        quantity = row['rewards__quantity'] or None
+        rewards.append({
+            'id': row['rewards__id'],
+            'minimum': float(row['rewards__minimum']),
+            'quantity': quantity,
+            'available': max(0, quantity - row['rewards__claimed'])
+            if quantity else None,
+        })
+
+    achieved = project['achieved_amount']
+    return {
+        'id': project['id'],
+        'goal': float(project['goal']),
+        'achieved': float(achieved),
+        'currency': project['currency'],
+        'percent': int(round((achieved * 100) / project['goal'])),
+        'backers': project['authorized_count'],
+        'end': project['end'],
+        'rewards': rewards,
+    }
+
+
+def get_project_status(slug):
+    """ Returns the funding status of an online project. It is cached until
+        the project, its rewards or its funding change. """
+    key = 'zipfelchappe:status:%s' % slug
+    status = cache.get(key)
+    if status is not None and \
+            status['version'] == get_version(project_namespace(status['id'])):
+        return status
+
+    status = load_project_status(slug)
+    status['version'] = get_version(project_namespace(status['id']))
+    status['etag'] = hashlib.md5(repr(sorted(status.items()))).hexdigest()
+    cache.set(key, status, app_settings.CACHE_TIMEOUT)
+    return status
+
+
+def remaining_seconds(status):
+    """ Returns the time left until the end of a project in seconds, rounded
+        down to the minute """
+    seconds = int((status['end'] - now()).total_seconds())
+    return max(0, seconds // 60 * 60)
+
+
+def dump_project_status(status):
+    """ Returns the public part of a funding status as JSON. The remaining
+        seconds are rounded down to the minute, so that the etag of a status
+        only changes once per minute. """
+    data = dict((k, v) for k, v in status.items()
+                if k not in ('id', 'version', 'etag'))
+    data['end'] = status['end'].isoformat()
+    data['remaining'] = remaining_seconds(status)
+    return json.dumps(data)
+
+
+@require_safe
+def project_status(request, slug):
+    """ Funding status of a project for progress widgets that poll it """
+    status = get_project_status(slug)
+    etag = '%s-%d' % (status['etag'], remaining_seconds(status))
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if etag in parse_etags(if_none_match):
+        return HttpResponseNotModified()
+
+    response = HttpResponse(dump_project_status(status),
+        content_type='application/json')
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
+@require_safe
+def project_events(request, slug):
+    """ Streams the funding status of a project as server-sent events """
+    broker = get_broker()
+    if broker is None:
+        raise Http404
+
+    project_id = load_project_status(slug)['id']
+    response = StreamingHttpResponse(
+        event_stream(broker, project_id,
+                     lambda: dump_project_status(load_project_status(slug))),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 def backer_create_view(request, slug):
     """ The main form to back a project. A lot of the magic here comes from
         BackProjectForm including all validation. The main job of this view is
@@ -222,10 +449,17 @@ def backer_create_view(request, slug):
 
         if form.is_valid() and extraform.is_valid():
             pledge = form.save(commit=False)
-            pledge.extradata = extraform.clean()
-            pledge.save()
-            request.session['pledge_id'] = pledge.id
-            return redirect('zipfelchappe_backer_authenticate')
+            try:
+                with atomic():
+                    pledge.save()
+                    pledge.set_extra_data(extraform.cleaned_data)
+            except RewardUnavailable:
+                # Another backer took the last one since validation
+                form._errors[NON_FIELD_ERRORS] = form.error_class([
+                    _('Sorry, this reward is not available anymore.')])
+            else:
+                request.session['pledge_id'] = pledge.id
+                return redirect('zipfelchappe_backer_authenticate')
     else:
         form = forms.BackProjectForm(**form_kwargs)
         extraform = ExtraForm(prefix="extra")
@@ -311,7 +545,7 @@ def pledge_thankyou(request):
     if not pledge:
         return redirect('zipfelchappe_project_list')
     else:
-        send_pledge_completed_message(pledge)
+        queue_pledge_completed_message(pledge)
         del request.session['pledge_id']
         request.session['completed_pledge_id'] = pledge.pk
         url = reverse('zipfelchappe_project_backed',  slug=pledge.project.slug)
@@ -326,6 +560,7 @@ def pledge_cancel(request):
         return redirect('zipfelchappe_project_list')
     else:
         del request.session['pledge_id']
+        pledge.release_reward()
         messages.info(request, _('Your pledge was canceled'))
         return redirect('zipfelchappe_project_detail', slug=pledge.project.slug)
 